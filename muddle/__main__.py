@@ -1,18 +1,17 @@
 #!/usr/bin/env python3
 
+# Only the modules needed by every command are imported here, the others
+# (requests, colorlog, PyQt, ...) take most of the startup time and are
+# imported where they are used, see test/startup.py
+
 import argparse
 import configparser
 import logging
-import colorlog
 
 import os
 import sys
-import platform
 import pathlib
-import json
 
-from . import moodle
-from . import gui
 from . import paths
 
 
@@ -26,8 +25,29 @@ parser.add_argument("-v", "--verbose", help="be more verbose", action="store_tru
 parser.add_argument("-c", "--config", help="configuration file", type=str)
 parser.add_argument("-l", "--logfile", help="where to save logs", type=str)
 parser.add_argument("-V", "--version", help="version", action="store_true")
+
+commands = parser.add_subparsers(dest="command")
+sync_parser = commands.add_parser("sync", help="download the files of the courses without graphical interface")
+sync_parser.add_argument("directory", help="where to save the files", type=str)
+sync_parser.add_argument("--course", help="id or short name of a course to download, "
+                         "can be given many times, all courses by default", action="append")
+daemon_parser = commands.add_parser("daemon", help="keep downloading the new files of the courses")
+daemon_parser.add_argument("directory", help="where to save the files", type=str)
+daemon_parser.add_argument("--course", help="id or short name of a course to download, "
+                           "can be given many times, all courses by default", action="append")
+commands.add_parser("status", help="show the state of the daemon")
 args = parser.parse_args()
 
+if args.version:
+    print(f"""Version {MUDDLE_VERSION}
+Muddle Copyright (C) 2020-2023 Nao Pross <np@0hm.ch>
+
+This program comes with ABSOLUTELY NO WARRANTY; This is free software, and you
+are welcome to redistribute it under certain conditions; see LICENSE.txt for
+details. Project repository: https://github.com/NaoPross/Muddle
+""")
+    sys.exit(0)
+
 # L O G G I N G
 
 logformatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
@@ -35,6 +55,8 @@ log = logging.getLogger("muddle")
 log.setLevel(logging.DEBUG)
 
 if args.verbose:
+    import colorlog
+
     cli_handler = colorlog.StreamHandler()
     cli_handler.setLevel(logging.DEBUG)
     cli_formatter = colorlog.ColoredFormatter(
@@ -100,14 +122,48 @@ config["runtime_data"]["config_path"] = str(config_file)
 
 # S T A R T
 
-if args.version:
-    print(f"""Version {MUDDLE_VERSION}
-Muddle Copyright (C) 2020-2023 Nao Pross <np@0hm.ch>
-
-This program comes with ABSOLUTELY NO WARRANTY; This is free software, and you
-are welcome to redistribute it under certain conditions; see LICENSE.txt for
-details. Project repository: https://github.com/NaoPross/Muddle
-""")
-
-if args.gui or config.getboolean("muddle", "always_run_gui"):
+if args.command in ("sync", "daemon"):
+    # without the graphical interface PyQt is never imported
+    from . import download
+    from . import moodle
+    from . import sync
+
+    if not config.has_option("server", "url") or not config.has_option("server", "token"):
+        log.error(f"the server url and token must be set in {config_file}")
+        sys.exit(1)
+
+    with sync.Sync(config, args.directory, args.course) as syncer:
+        try:
+            if args.command == "daemon":
+                import signal
+                from . import daemon
+
+                signal.signal(signal.SIGTERM, lambda *_: syncer.cancel.cancel())
+                daemon.Daemon.fromconfig(syncer, config).run()
+                sys.exit(0)
+
+            manager = syncer.run()
+        except KeyboardInterrupt:
+            syncer.cancel.cancel()
+            sys.exit(130)
+        except moodle.Cancelled:
+            sys.exit(130)
+        except moodle.MoodleException as e:
+            log.error(f"cannot get the enrolled courses: {e}")
+            sys.exit(1)
+
+    failed = manager.count(download.Status.FAILED)
+    print(f"{manager.count(download.Status.DONE)} downloaded, "
+          f"{manager.count(download.Status.SKIPPED)} up to date, {failed} failed"
+          + (f", {len(syncer.failed_courses)} courses skipped" if syncer.failed_courses else ""))
+    sys.exit(1 if failed or syncer.failed_courses else 0)
+
+elif args.command == "status":
+    from . import daemon
+
+    print(daemon.format_status(daemon.read_state(
+        config.get("daemon", "state_file", fallback=str(paths.default_daemon_state_file)))))
+
+elif args.gui or config.getboolean("muddle", "always_run_gui"):
+    from . import gui
     gui.start(config)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+asyncio counterparts of moodle.RestApi and moodle.MoodleInstance
+
+This requires the optional aiohttp dependency (poetry install -E async).
+The responses are decoded into the same schema objects used by the
+synchronous API, so these two are equivalent:
+
+    for s in course.get_sections(instance.api): ...
+    for s in await aioinstance.get_sections(course): ...
+"""
+import asyncio
+import logging
+import urllib.parse
+
+import aiohttp
+
+from . import moodle
+
+log = logging.getLogger("muddle.aiomoodle")
+
+
+class AsyncRestApi:
+    """
+    Magic REST API wrapper, like moodle.RestApi but every function is a
+    coroutine that returns the decoded JSON response (or None on failure)
+    """
+    def __init__(self, instance_url, token=None, session=None, limit_per_host=10):
+        self._url = instance_url
+        self._token = token
+        self._limit_per_host = limit_per_host
+        # only close the session on exit if it was created here
+        self._ownssession = session is None
+        self._session = session
+        self._semaphores = {}
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+
+        return lambda **kwargs: self._call(str(key), **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def session(self):
+        # created lazily because aiohttp wants a running event loop
+        if self._session is None:
+            # no global limit, concurrency is bounded by the semaphores
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self._limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector)
+
+        return self._session
+
+    async def close(self):
+        if self._ownssession and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _semaphore(self, host):
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self._limit_per_host)
+
+        return self._semaphores[host]
+
+    async def _call(self, function, **kwargs):
+        api_url = f"{self._url}/webservice/rest/server.php?moodlewsrestformat=json"
+        data = {"wstoken": self._token, "wsfunction": function}
+        for k, v in kwargs.items():
+            # like requests, which leaves out the fields that are None
+            if v is not None:
+                data[str(k)] = str(v)
+
+        log.debug(f"calling api with async POST to {api_url} with DATA {data}")
+        async with self._semaphore(urllib.parse.urlsplit(api_url).hostname):
+            try:
+                async with self.session.post(api_url, data=data) as req:
+                    req.raise_for_status()
+                    # moodle does not always set the content type correctly
+                    return await req.json(content_type=None)
+
+            except aiohttp.ClientResponseError:
+                log.warning("Error code returned by HTTP(s) request")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.error(f"Failed to connect for POST request:\n{str(e)}")
+
+        return None
+
+
+class AsyncMoodleInstance:
+    """
+    A more frendly API that wraps around the AsyncRestApi, mirrors the
+    methods of moodle.MoodleInstance
+    """
+    def __init__(self, url, token, session=None, limit_per_host=10):
+        self.api = AsyncRestApi(url, token, session, limit_per_host)
+        self.userid = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.api.close()
+
+    async def get_userid(self):
+        """
+        Id of the user of the token, None if the site info is not available
+        """
+        if self.userid is None:
+            info = await self.api.core_webservice_get_site_info()
+            if not isinstance(info, dict) or "userid" not in info:
+                log.error(f"cannot get the site info: {_error_message(info)}")
+                return None
+
+            self.userid = info["userid"]
+
+        return self.userid
+
+    async def get_enrolled_courses(self):
+        courses = await self.api.core_enrol_get_users_courses(userid=await self.get_userid())
+        if not isinstance(courses, list):
+            log.error(f"cannot get the enrolled courses: {_error_message(courses)}")
+            return []
+
+        return [moodle.Course._fromdict(c) for c in courses]
+
+    async def get_sections(self, course):
+        sections = await self.api.core_course_get_contents(courseid=course.id)
+        if not isinstance(sections, list):
+            log.error(f"cannot get the sections of course {course.id}: {_error_message(sections)}")
+            return []
+
+        for s in sections:
+            # rest api response does not contain course id
+            s["course"] = course.id
+
+        return [moodle.Section._fromdict(s) for s in sections]
+
+    async def get_all_sections(self, courses):
+        """
+        Fetches the sections of many courses concurrently, returns a dict
+        that maps the course id to its sections
+        """
+        results = await asyncio.gather(*(self.get_sections(c) for c in courses))
+        return {c.id: sections for c, sections in zip(courses, results)}
+
+
+def _error_message(response):
+    if isinstance(response, dict):
+        return response.get("message") or response.get("exception")
+
+    return "the request failed"
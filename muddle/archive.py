@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import logging
+import os
+import struct
+import zlib
+
+log = logging.getLogger("muddle.archive")
+
+LOCAL_HEADER = b"PK\x03\x04"
+DATA_DESCRIPTOR = b"PK\x07\x08"
+# the central directory at the end repeats what was already read
+CENTRAL_HEADER = b"PK\x01\x02"
+END_OF_CENTRAL = b"PK\x05\x06"
+
+# signature, version, flags, method, time, date, crc, sizes, name and extra length
+_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+
+FLAG_ENCRYPTED = 0x01
+FLAG_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+STORED = 0
+DEFLATED = 8
+
+
+class ArchiveError(Exception):
+    """
+    The archive is broken or uses a feature that cannot be streamed
+    """
+    pass
+
+
+class _Reader:
+    """
+    Reads exact amounts of bytes from an iterator of chunks, with push back
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = bytearray()
+
+    def read(self, n):
+        while len(self._buf) < n:
+            self._fill()
+
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+    def take(self):
+        """
+        Returns what is buffered or else the next chunk
+        """
+        if not self._buf:
+            self._fill()
+
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+    def unread(self, data):
+        self._buf[:0] = data
+
+    def _fill(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            raise ArchiveError("the archive is truncated")
+
+        # chunks may be views of a buffer that is reused
+        self._buf += chunk
+
+
+def iter_zip(chunks):
+    """
+    Iterates over the entries of a zip archive while it is downloaded,
+    without seeking, by reading the local headers that precede every entry.
+    Yields the name of the entry and an iterator over its content, which must
+    be consumed before moving to the next entry. The CRC of every entry is
+    checked once it has been read completely.
+    """
+    reader = _Reader(chunks)
+
+    while True:
+        signature = reader.read(4)
+        if signature in (CENTRAL_HEADER, END_OF_CENTRAL):
+            return
+        if signature != LOCAL_HEADER:
+            raise ArchiveError("not a zip archive")
+
+        header = _LOCAL_HEADER.unpack(signature + reader.read(_LOCAL_HEADER.size - 4))
+        _, _, flags, method, _, _, crc, csize, usize, namelen, extralen = header
+        raw_name = reader.read(namelen)
+        extra = reader.read(extralen)
+
+        if flags & FLAG_ENCRYPTED:
+            raise ArchiveError("encrypted archives are not supported")
+
+        name = raw_name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+        zip64 = _zip64_sizes(extra)
+        if zip64 and csize == 0xFFFFFFFF:
+            usize, csize = zip64
+
+        if method == DEFLATED:
+            data = _inflate(reader)
+        elif method == STORED and not (flags & FLAG_DESCRIPTOR and csize == 0):
+            data = _stored(reader, csize)
+        else:
+            raise ArchiveError(f"cannot stream {name}, compression method {method}")
+
+        entry = _checked(data, reader, flags, crc, zip64 is not None, name)
+        yield name, entry
+
+        # skip what the caller did not read
+        for _ in entry:
+            pass
+
+
+def _zip64_sizes(extra):
+    """
+    Uncompressed and compressed size in the zip64 extra field, if any
+    """
+    while len(extra) >= 4:
+        tag, size = struct.unpack("<HH", extra[:4])
+        if tag == 0x0001 and size >= 16:
+            return struct.unpack("<QQ", extra[4:20])
+        extra = extra[4 + size:]
+
+    return None
+
+
+def _stored(reader, size):
+    while size:
+        data = reader.take()
+        if len(data) > size:
+            reader.unread(data[size:])
+            data = data[:size]
+
+        size -= len(data)
+        yield data
+
+
+def _inflate(reader, max_length=1024 * 1024):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = b""
+    while not decompressor.eof:
+        if not data:
+            data = reader.take()
+
+        out = decompressor.decompress(data, max_length)
+        data = decompressor.unconsumed_tail
+        if out:
+            yield out
+
+    reader.unread(decompressor.unused_data + data)
+
+
+def _checked(data, reader, flags, crc, zip64, name):
+    actual = 0
+    for chunk in data:
+        actual = zlib.crc32(chunk, actual)
+        yield chunk
+
+    if flags & FLAG_DESCRIPTOR:
+        # the signature of the data descriptor is optional
+        first = reader.read(4)
+        crc = struct.unpack("<I", reader.read(4) if first == DATA_DESCRIPTOR else first)[0]
+        reader.read(16 if zip64 else 8)
+
+    if actual != crc:
+        raise ArchiveError(f"{name} is corrupted")
+
+
+def extract(chunks, path_for, cancel=None, progress=None, hasher=None):
+    """
+    Extracts a zip archive while it is downloaded. path_for(name) returns
+    where an entry is saved, or None to skip it. Every file is written next
+    to its destination and renamed once it is complete and its CRC matches.
+    Returns the paths of the extracted files, mapped to a hashlib object
+    returned by hasher() and updated with their content, or to None.
+    """
+    extracted = {}
+    for name, data in iter_zip(chunks):
+        if name.endswith("/"):
+            continue
+
+        path = path_for(name)
+        if path is None:
+            log.debug(f"skipping {name} in archive")
+            continue
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part = path.with_name(path.name + ".part")
+        digest = hasher() if hasher else None
+        try:
+            with open(part, "wb") as f:
+                for chunk in data:
+                    if cancel:
+                        cancel.check()
+                    f.write(chunk)
+                    if digest:
+                        digest.update(chunk)
+                    if progress:
+                        progress(len(chunk))
+        except BaseException:
+            os.remove(part)
+            raise
+
+        os.replace(part, path)
+        extracted[path] = digest
+
+    return extracted
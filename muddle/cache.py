@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import logging
+import pathlib
+import shutil
+import sqlite3
+import threading
+import time
+
+from . import paths
+
+log = logging.getLogger("muddle.cache")
+
+# Default time to live of the responses in seconds, functions that are not
+# listed here are never cached. The course contents are left out on purpose
+# because a refresh is expected to show new files.
+DEFAULT_TTL = {
+    "core_webservice_get_site_info": 24 * 60 * 60,
+    "core_enrol_get_users_courses": 60 * 60,
+}
+
+
+class ResponseCache:
+    """
+    On disk cache for webservice responses, stored in a sqlite database.
+
+    Entries expire after the time to live of their function and once the
+    stored responses exceed max_size bytes the least recently used are
+    evicted. The cache may be shared between threads.
+    """
+    def __init__(self, path=paths.default_cache_file, max_size=32 * 1024 * 1024, ttl=None):
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+        self.ttl = dict(DEFAULT_TTL)
+        self.ttl.update(ttl or {})
+
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                function TEXT,
+                body BLOB,
+                size INTEGER,
+                created REAL,
+                accessed REAL)""")
+        self._db.commit()
+
+    @classmethod
+    def fromconfig(cls, config):
+        """
+        Creates a cache with the settings found in the [cache] section,
+        returns None if the cache is disabled
+        """
+        if not config.getboolean("cache", "enabled", fallback=True):
+            return None
+
+        ttl = {}
+        if config.has_section("cache"):
+            for option, value in config.items("cache"):
+                if option.startswith("ttl_"):
+                    ttl[option[len("ttl_"):]] = int(value)
+
+        return cls(
+            path=config.get("cache", "path", fallback=str(paths.default_cache_file)),
+            max_size=config.getint("cache", "max_size", fallback=32) * 1024 * 1024,
+            ttl=ttl)
+
+    @staticmethod
+    def key(url, token, function, args):
+        """
+        Key of a call, arguments are normalized so that courseid=1 and
+        courseid="1" are the same entry. The token is hashed with the rest,
+        so it is never written to disk.
+        """
+        normalized = sorted((str(k), str(v)) for k, v in args.items())
+        raw = json.dumps([url, token, function, normalized])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def cacheable(self, function):
+        return self.ttl.get(function, 0) > 0
+
+    def get(self, key, function):
+        """
+        Returns the cached body or None if there is no valid entry
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body FROM responses WHERE key = ? AND created > ?",
+                (key, now - self.ttl.get(function, 0))).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+
+        log.debug(f"cache hit for {function}")
+        return row[0]
+
+    def put(self, key, function, body):
+        if len(body) > self.max_size:
+            log.debug(f"response of {function} is too big to be cached")
+            return
+
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, function, body, len(body), now, now))
+            self._evict()
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _evict(self):
+        # drop expired entries, then the least recently used ones
+        for function, ttl in self.ttl.items():
+            self._db.execute(
+                "DELETE FROM responses WHERE function = ? AND created <= ?",
+                (function, time.time() - ttl))
+
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+
+class FileCache:
+    """
+    Cache of the files that were opened, so that opening them again does not
+    need to download them. An entry is valid as long as the timemodified of
+    the file on the server does not change. Once the files exceed max_size
+    bytes the least recently opened are removed.
+    """
+    def __init__(self, path=paths.default_open_cache_dir, max_size=256 * 1024 * 1024):
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path / "index.sqlite"), check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                timemodified INTEGER,
+                size INTEGER,
+                accessed REAL)""")
+        self._db.commit()
+
+    @classmethod
+    def fromconfig(cls, config):
+        """
+        Creates a cache with the settings found in the [cache] section,
+        returns None if the cache is disabled
+        """
+        if not config.getboolean("cache", "enabled", fallback=True):
+            return None
+
+        return cls(
+            path=config.get("cache", "open_path", fallback=str(paths.default_open_cache_dir)),
+            max_size=config.getint("cache", "open_max_size", fallback=256) * 1024 * 1024)
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def path_for(self, url, filename):
+        """
+        Where the file of url is kept, the name of the file is preserved so
+        that it is opened with the right application
+        """
+        return self.path / self.key(url)[:32] / filename
+
+    def get(self, url, filename, timemodified):
+        """
+        Returns the path of the cached file or None if there is no valid entry
+        """
+        key = self.key(url)
+        path = self.path_for(url, filename)
+        with self._lock:
+            row = self._db.execute("SELECT timemodified FROM files WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] != timemodified or not path.exists():
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._db.execute("UPDATE files SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+
+        log.debug(f"open cache hit for {filename}")
+        return path
+
+    def put(self, url, filename, timemodified):
+        """
+        Records the file that was downloaded to path_for(url, filename)
+        """
+        key = self.key(url)
+        path = self.path_for(url, filename)
+        size = path.stat().st_size
+
+        # the file may have been renamed on the server
+        for other in path.parent.iterdir():
+            if other != path:
+                other.unlink()
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (key, url, timemodified, size, time.time()))
+            self._evict(keep=key)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _evict(self, keep):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        rows = self._db.execute("SELECT key, size FROM files ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+
+            self._db.execute("DELETE FROM files WHERE key = ?", (key,))
+            shutil.rmtree(self.path / key[:32], ignore_errors=True)
+            total -= size
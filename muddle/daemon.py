@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Keeps the download directory in sync with the courses, polling each course
+on its own schedule. Like sync, this module must not import anything from Qt
+"""
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import platform
+import time
+
+from . import download
+from . import moodle
+from . import paths
+
+log = logging.getLogger("muddle.daemon")
+
+
+@dataclasses.dataclass
+class CourseState:
+    """
+    Polling schedule of a course, times are unix timestamps
+    """
+    id: int
+    shortname: str = ""
+    # seconds between two polls, adapted to how often the course changes
+    interval: float = 0
+    next_poll: float = 0
+    last_poll: float = 0
+    # changes after this time are asked to the server at the next poll
+    last_sync: int = 0
+    last_change: float = 0
+    downloaded: int = 0
+    error: str = None
+
+
+class Daemon:
+    """
+    Polls the selected courses of a sync.Sync for changes and downloads the
+    new files, reusing the same client and connections.
+
+    Each course has its own interval between polls: it is divided by backoff
+    every time the course changed, down to min_interval, and multiplied by
+    backoff every time it did not, up to max_interval. So busy courses are
+    polled often and dormant ones rarely. The list of enrolled courses is
+    refreshed every courses_interval seconds.
+
+    The schedule is saved to state_path after every poll, to resume it after
+    a restart and to show it with the status command, see read_state().
+    """
+    def __init__(self, syncer, state_path=paths.default_daemon_state_file, min_interval=5 * 60,
+                 max_interval=24 * 60 * 60, backoff=2.0, courses_interval=60 * 60):
+        self.syncer = syncer
+        self.cancel = syncer.cancel
+        self.state_path = pathlib.Path(state_path)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.courses_interval = courses_interval
+
+        self.courses = {}
+        self.states = {}
+        self.started = time.time()
+        self.status = "starting"
+        self._courses_fetched = 0
+
+        for c in read_state(state_path).get("courses", {}).values():
+            state = CourseState(**c)
+            self.states[state.id] = state
+
+    @classmethod
+    def fromconfig(cls, syncer, config):
+        """
+        Creates a daemon with the settings found in the [daemon] section
+        """
+        return cls(
+            syncer,
+            state_path=config.get("daemon", "state_file", fallback=str(paths.default_daemon_state_file)),
+            min_interval=config.getfloat("daemon", "min_interval", fallback=5 * 60),
+            max_interval=config.getfloat("daemon", "max_interval", fallback=24 * 60 * 60),
+            backoff=config.getfloat("daemon", "backoff", fallback=2.0),
+            courses_interval=config.getfloat("daemon", "courses_interval", fallback=60 * 60))
+
+    def run(self):
+        """
+        Polls until the sync is cancelled
+        """
+        try:
+            while True:
+                if time.time() - self._courses_fetched >= self.courses_interval:
+                    self.refresh_courses()
+
+                # the state of the courses may be loaded before they are
+                pending = [s for s in self.states.values() if s.id in self.courses]
+                if not pending:
+                    self.set_status("idle")
+                    self.cancel.wait(max(self._courses_fetched + self.courses_interval - time.time(), 0))
+                    continue
+
+                state = min(pending, key=lambda s: s.next_poll)
+                delay = state.next_poll - time.time()
+                if delay > 0:
+                    self.set_status("idle")
+                    # wake up to refresh the courses as well
+                    self.cancel.wait(min(delay, self._courses_fetched + self.courses_interval - time.time()))
+                    continue
+
+                self.poll(state)
+        except moodle.Cancelled:
+            log.info("daemon stopped")
+        finally:
+            self.set_status("stopped")
+
+    def refresh_courses(self):
+        try:
+            courses = [c for c in self.syncer.instance.get_enrolled_courses() if self.syncer.selected(c)]
+        except moodle.Cancelled:
+            raise
+        except Exception as e:
+            log.error(f"cannot get the enrolled courses: {e}")
+            # try again with the next poll
+            self._courses_fetched = time.time() - self.courses_interval + self.min_interval
+            return
+
+        self._courses_fetched = time.time()
+        self.courses = {c.id: c for c in courses}
+        for course in courses:
+            state = self.states.setdefault(course.id, CourseState(course.id, interval=self.min_interval))
+            state.shortname = course.shortname
+
+        # no longer enrolled
+        for courseid in set(self.states) - set(self.courses):
+            del self.states[courseid]
+
+        log.info(f"polling {len(self.courses)} courses")
+
+    def poll(self, state):
+        """
+        Downloads the new files of a course, if it changed since the last
+        poll, and schedules the next poll
+        """
+        course = self.courses[state.id]
+        self.set_status(f"syncing {course.shortname}")
+        started = time.time()
+        changed = False
+        try:
+            updated = None
+            if state.last_sync and self.syncer.instance.api.supports("core_course_get_updates_since") is not False:
+                updated = self.syncer.apihelper.get_updates_since(course.id, state.last_sync)
+
+            if updated is not None and not updated:
+                log.debug(f"course {course.shortname} did not change")
+            else:
+                manager = self.syncer.run([course])
+                downloaded = manager.count(download.Status.DONE)
+                failed = manager.count(download.Status.FAILED)
+                changed = bool(updated) or downloaded > 0
+                state.downloaded += downloaded
+                if self.syncer.failed_courses:
+                    raise RuntimeError("cannot list the files")
+                if failed:
+                    raise RuntimeError(f"{failed} files failed")
+
+            # failed files are tried again at the next poll
+            state.last_sync = int(started) - moodle.SYNC_MARGIN
+            state.error = None
+        except moodle.Cancelled:
+            raise
+        except Exception as e:
+            log.error(f"cannot sync {course.shortname}: {e}")
+            state.error = str(e)
+
+        if changed:
+            state.last_change = started
+
+        state.last_poll = started
+        state.interval = self.adapt(state.interval, changed)
+        state.next_poll = time.time() + state.interval
+        log.info(f"next poll of {course.shortname} in {state.interval:.0f} s")
+        self.save()
+
+    def adapt(self, interval, changed):
+        """
+        Interval until the next poll of a course that was polled after
+        interval seconds and did or did not change
+        """
+        interval = interval / self.backoff if changed else interval * self.backoff
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def set_status(self, status):
+        if status != self.status:
+            self.status = status
+            self.save()
+
+    def save(self):
+        state = {
+            "pid": os.getpid(),
+            "started": self.started,
+            "updated": time.time(),
+            "status": self.status,
+            "directory": str(self.syncer.root),
+            "courses": {str(s.id): dataclasses.asdict(s) for s in self.states.values()},
+        }
+
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_path.with_name(self.state_path.name + ".tmp")
+        tmp.write_text(json.dumps(state, indent=1, sort_keys=True))
+        os.replace(tmp, self.state_path)
+
+
+def read_state(path=paths.default_daemon_state_file):
+    """
+    State saved by a daemon, empty if there is none
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log.warning(f"ignoring unreadable daemon state {path}: {e}")
+        return {}
+
+
+def running(state):
+    """
+    True if the process that saved state is still running
+    """
+    if not state.get("pid") or state.get("status") == "stopped":
+        return False
+
+    return _alive(state["pid"])
+
+
+def _alive(pid):
+    if platform.system() == "Windows":
+        # signal 0 is CTRL_C_EVENT there, it would interrupt the daemon
+        import ctypes
+
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        ERROR_ACCESS_DENIED = 5
+        STILL_ACTIVE = 259
+
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            # a process of another user
+            return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+
+        try:
+            code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return False
+            return code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+
+    return True
+
+
+def format_status(state):
+    """
+    Human readable summary of the state saved by a daemon
+    """
+    def when(timestamp):
+        return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp)) if timestamp else "never"
+
+    def every(seconds):
+        if seconds < 2 * 60:
+            return f"{seconds:.0f} s"
+        if seconds < 2 * 60 * 60:
+            return f"{seconds / 60:.0f} min"
+        return f"{seconds / 60 / 60:.1f} h"
+
+    if not state:
+        return "the daemon never ran"
+
+    lines = [
+        f"daemon {'running, pid ' + str(state['pid']) if running(state) else 'not running'}, "
+        f"{state.get('status')} since {when(state.get('updated'))}",
+        f"downloading to {state.get('directory')}",
+        "",
+        f"{'course':<24} {'every':>9} {'last poll':>17} {'last change':>17} {'next poll':>17}",
+    ]
+    for c in sorted(state.get("courses", {}).values(), key=lambda c: c["next_poll"]):
+        lines.append(f"{c['shortname'][:24]:<24} {every(c['interval']):>9} {when(c['last_poll']):>17} "
+                     f"{when(c['last_change']):>17} {when(c['next_poll']):>17}")
+        if c.get("error"):
+            lines.append(f"  error: {c['error']}")
+
+    return "\n".join(lines)
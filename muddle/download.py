@@ -0,0 +1,637 @@
+#!/usr/bin/env python3
+import concurrent.futures
+import dataclasses
+import enum
+import errno
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import pathlib
+import re
+import shutil
+import threading
+import time
+
+from . import archive
+from . import moodle
+
+log = logging.getLogger("muddle.download")
+
+
+def safe_name(name):
+    """
+    Turns the name of a course, section, module or file into something that
+    can be used as a path component on every platform
+    """
+    name = re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", name).strip().rstrip(".")
+    return name or "_"
+
+
+class Status(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    # nothing had to be downloaded, the local copy is up to date or the
+    # content was already in the store
+    SKIPPED = "skipped"
+
+
+class Priority(enum.IntEnum):
+    """
+    Classes of downloads, lower values are more urgent
+    """
+    # a file the user is waiting for, e.g. to open it
+    INTERACTIVE = 0
+    # files the user asked to download
+    SELECTED = 1
+    # files downloaded by a sync
+    BACKGROUND = 2
+    # files that may be needed soon
+    SPECULATIVE = 3
+
+
+@dataclasses.dataclass
+class Task:
+    """
+    A file to download, filesize and timemodified come from the contents of
+    a module and are 0 if unknown
+    """
+    url: str
+    path: pathlib.Path
+    filesize: int = 0
+    timemodified: int = 0
+    status: Status = Status.QUEUED
+    received: int = 0
+    error: str = None
+    # the files of an archive, whose path is the directory it is extracted to
+    files: list = None
+    # hash of the downloaded content as "algorithm:hexdigest"
+    digest: str = None
+
+
+class Manifest:
+    """
+    Record of the files downloaded into a directory, saved as JSON in the
+    directory itself. Paths are relative to the directory.
+
+    The content of every file is hashed with algorithm while it is
+    downloaded, so that the copy can be verified later without the server.
+    """
+    FILENAME = ".muddle-manifest.json"
+
+    def __init__(self, root, algorithm="sha256"):
+        self.root = pathlib.Path(root)
+        self.path = self.root / self.FILENAME
+        self._lock = threading.Lock()
+
+        if algorithm == "none":
+            algorithm = None
+        elif algorithm and algorithm not in hashlib.algorithms_available:
+            log.warning(f"unknown hash algorithm {algorithm}, using sha256")
+            algorithm = "sha256"
+        self.algorithm = algorithm or None
+
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            log.warning(f"ignoring unreadable manifest {self.path}: {e}")
+            self.entries = {}
+
+    def key(self, path):
+        return pathlib.Path(path).relative_to(self.root).as_posix()
+
+    def get(self, path):
+        return self.entries.get(self.key(path))
+
+    def hasher(self):
+        """
+        A new hashlib object, None if hashing is disabled
+        """
+        return hashlib.new(self.algorithm) if self.algorithm else None
+
+    def unchanged(self, task):
+        """
+        True if the local copy of the task has the size and modification time
+        of the file on the server. Without both of them nothing is skipped.
+
+        The modification time is the one recorded when the file was
+        downloaded, the one on disk is shared by the links of a BlobStore
+        and only used for files that are not in the manifest
+        """
+        if not task.filesize or not task.timemodified:
+            return False
+
+        try:
+            st = task.path.stat()
+        except FileNotFoundError:
+            return False
+
+        if st.st_size != task.filesize:
+            return False
+
+        entry = self.get(task.path)
+        if entry is not None:
+            return entry.get("filesize") == task.filesize and entry.get("timemodified") == task.timemodified
+
+        return int(st.st_mtime) == task.timemodified
+
+    def record(self, task):
+        with self._lock:
+            self.entries[self.key(task.path)] = {
+                "url": task.url,
+                "filesize": task.filesize,
+                "timemodified": task.timemodified,
+                "downloaded": int(time.time()),
+                "hash": task.digest,
+            }
+
+    def verify(self):
+        """
+        Hashes the local copy of every file that has a hash in the manifest
+        again. Returns the paths of those that are missing or differ.
+        """
+        with self._lock:
+            entries = dict(self.entries)
+
+        damaged = []
+        for key, entry in sorted(entries.items()):
+            if not entry.get("hash"):
+                continue
+
+            algorithm, expected = entry["hash"].split(":", 1)
+            path = self.root / key
+            digest = hashlib.new(algorithm)
+            try:
+                moodle.hash_file(path, digest)
+            except FileNotFoundError:
+                log.warning(f"{path} is missing")
+                damaged.append(path)
+                continue
+
+            if digest.hexdigest() != expected:
+                log.warning(f"{path} differs from the downloaded file")
+                damaged.append(path)
+
+        return damaged
+
+    def save(self):
+        with self._lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+            os.replace(tmp, self.path)
+
+
+class BlobStore:
+    """
+    Content addressed storage of the downloaded files, each content is stored
+    once as objects/<hash> and the files of the tree are links to it. Links
+    are hardlinks, or reflinks (copy on write clones) where hardlinks are not
+    possible, as a last resort the content is copied.
+
+    An index remembers the hash of every url and timemodified, so the files
+    that were already downloaded once are linked without a request.
+    """
+    ALGORITHM = "sha256"
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self.objects = self.root / "objects"
+        self.index_path = self.root / "index.json"
+        self._lock = threading.Lock()
+
+        self.objects.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+        except (OSError, ValueError) as e:
+            log.warning(f"ignoring unreadable index {self.index_path}: {e}")
+            self.index = {}
+
+    def hasher(self):
+        return hashlib.new(self.ALGORITHM)
+
+    def blob(self, digest):
+        return self.objects / digest[:2] / digest
+
+    def lookup(self, url, timemodified=0):
+        """
+        Hash of the content of url if it is in the store, None otherwise
+        """
+        with self._lock:
+            digest = self.index.get(f"{timemodified} {url}")
+
+        if digest and self.blob(digest).exists():
+            return digest
+
+        return None
+
+    def add(self, path, digest, url, timemodified=0):
+        """
+        Moves the downloaded file at path into the store, unless the same
+        content is already there, and replaces it with a link
+        """
+        blob = self.blob(digest)
+        blob.parent.mkdir(exist_ok=True)
+        with self._lock:
+            if blob.exists():
+                os.remove(path)
+            else:
+                os.replace(path, blob)
+
+            self.index[f"{timemodified} {url}"] = digest
+
+        self.link(digest, path)
+
+    def link(self, digest, path):
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # replace an existing file atomically
+        tmp = path.with_name(path.name + ".link")
+        _link(self.blob(digest), tmp)
+        os.replace(tmp, path)
+
+    def save(self):
+        with self._lock:
+            tmp = self.index_path.with_name(self.index_path.name + ".tmp")
+            tmp.write_text(json.dumps(self.index, indent=1, sort_keys=True))
+            os.replace(tmp, self.index_path)
+
+
+# ioctl of linux to clone a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+
+    try:
+        import fcntl
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+
+    shutil.copyfile(src, dst)
+
+
+class _Digests:
+    """
+    Updates several hashlib objects with the same data, to hash a download
+    with different algorithms at once
+    """
+    def __init__(self, digests):
+        self.digests = digests
+
+    def update(self, data):
+        for digest in self.digests:
+            digest.update(data)
+
+
+class _Job:
+    def __init__(self, fn, priority, cancel):
+        self.fn = fn
+        self.priority = priority
+        self.cancel = cancel
+        self.future = concurrent.futures.Future()
+        self.submitted = time.monotonic()
+        self.started = None
+        # cancels the current run only, see Scheduler._preempt()
+        self.token = None
+        self.preempted = False
+
+
+class Scheduler:
+    """
+    Runs downloads on at most slots threads at a time, the most urgent first.
+
+    When all the slots are taken, a job that is more urgent than one of the
+    running jobs preempts it: the running job is cancelled and queued again.
+    Since downloads resume from their .part file (see ApiHelper.get_file)
+    little of its work is lost. The scheduler may be shared by many download
+    managers and by single downloads.
+    """
+    def __init__(self, slots=4):
+        self.slots = slots
+        # for monitoring
+        self.preemptions = 0
+
+        self._lock = threading.Lock()
+        self._queue = []
+        self._running = set()
+        self._seq = itertools.count()
+        self._stats = {p: {"count": 0, "wait": 0.0, "max_wait": 0.0, "time": 0.0} for p in Priority}
+
+    def submit(self, fn, priority=Priority.SELECTED, cancel=None):
+        """
+        Schedules fn(token), where token is a CancelToken that is cancelled
+        when the job is preempted or when cancel is. If fn raises Cancelled
+        because it was preempted it is run again later. Returns a Future with
+        the result of fn.
+        """
+        job = _Job(fn, Priority(priority), cancel or moodle.CancelToken())
+        with self._lock:
+            heapq.heappush(self._queue, (job.priority, next(self._seq), job))
+            self._preempt(job)
+            self._dispatch()
+
+        return job.future
+
+    def stats(self):
+        """
+        Number of jobs, average and longest wait in the queue and average time
+        until done (both in seconds) by priority
+        """
+        with self._lock:
+            stats = {}
+            for priority, s in self._stats.items():
+                count = s["count"] or 1
+                stats[priority] = {"count": s["count"], "wait": s["wait"] / count,
+                                   "max_wait": s["max_wait"], "time": s["time"] / count}
+            return stats
+
+    def _preempt(self, job):
+        # with the lock held
+        if len(self._running) < self.slots:
+            return
+
+        victims = [j for j in self._running if j.priority > job.priority]
+        if not victims:
+            return
+
+        # the least urgent, and of those the one that lost the least work
+        victim = max(victims, key=lambda j: (j.priority, j.started))
+        victim.preempted = True
+        self._running.discard(victim)
+        self.preemptions += 1
+        log.debug(f"{job.priority.name.lower()} job preempts a {victim.priority.name.lower()} one")
+        victim.token.cancel()
+
+    def _dispatch(self):
+        # with the lock held
+        while self._queue and len(self._running) < self.slots:
+            _, _, job = heapq.heappop(self._queue)
+            if job.started is None:
+                wait = time.monotonic() - job.submitted
+                s = self._stats[job.priority]
+                s["wait"] += wait
+                s["max_wait"] = max(s["max_wait"], wait)
+
+            job.started = time.monotonic()
+            job.token = job.cancel.child()
+            job.preempted = False
+            self._running.add(job)
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        result = exception = None
+        try:
+            result = job.fn(job.token)
+        except moodle.Cancelled as e:
+            with self._lock:
+                if job.preempted and not job.cancel.cancelled:
+                    heapq.heappush(self._queue, (job.priority, next(self._seq), job))
+                    self._dispatch()
+                    return
+            exception = e
+        except BaseException as e:
+            exception = e
+
+        with self._lock:
+            self._running.discard(job)
+            s = self._stats[job.priority]
+            s["count"] += 1
+            s["time"] += time.monotonic() - job.submitted
+            self._dispatch()
+
+        if exception is not None:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
+
+
+class DownloadManager:
+    """
+    Downloads many files in parallel, with a scheduler of its own with
+    workers slots or with a shared one.
+
+    The callbacks are called from the worker threads: on_status(task) when
+    the status of a task changes and on_progress(received, total) with the
+    bytes of all the tasks together.
+
+    With a manifest, files whose local copy is unchanged are skipped and the
+    modification time of the downloaded ones is set to the one on the server.
+    With a store, files are deduplicated, see BlobStore. Files are hashed
+    while they are downloaded, for the store and for the manifest.
+    """
+    def __init__(self, apihelper, workers=4, cancel=None, on_status=None, on_progress=None, manifest=None,
+                 store=None, scheduler=None, priority=Priority.SELECTED):
+        self.apihelper = apihelper
+        self.scheduler = scheduler or Scheduler(workers)
+        self.priority = priority
+        self.cancel = cancel or moodle.CancelToken()
+        self.manifest = manifest
+        self.store = store
+        self.on_status = on_status
+        self.on_progress = on_progress
+        self.tasks = []
+
+        self._lock = threading.Lock()
+        self._received = 0
+
+    def add(self, url, path, filesize=0, timemodified=0):
+        task = Task(url, pathlib.Path(path), filesize, timemodified)
+        self.tasks.append(task)
+        return task
+
+    def add_archive(self, url, path, files):
+        """
+        Adds the download of a zip archive at url that is extracted to the
+        directory path, files are the (url, path, filesize, timemodified) of
+        its content to download one by one if the archive is not available
+        """
+        files = [Task(*f) for f in files]
+        for f in files:
+            f.path = pathlib.Path(f.path)
+
+        task = Task(url, pathlib.Path(path), sum(f.filesize for f in files),
+                    max((f.timemodified for f in files), default=0), files=files)
+        self.tasks.append(task)
+        return task
+
+    @property
+    def total(self):
+        return sum(t.filesize for t in self.tasks)
+
+    def count(self, status):
+        return sum(1 for t in self.tasks if t.status == status)
+
+    def run(self):
+        """
+        Downloads every task that is queued, blocks until all are done. Returns
+        True if all of them succeeded.
+        """
+        queued = [t for t in self.tasks if t.status == Status.QUEUED]
+        try:
+            futures = [self.scheduler.submit(functools.partial(self._download, t), self.priority, self.cancel)
+                       for t in queued]
+            for future in futures:
+                future.result()
+        finally:
+            if self.manifest:
+                self.manifest.save()
+            if self.store:
+                self.store.save()
+
+        return all(t.status in (Status.DONE, Status.SKIPPED) for t in queued)
+
+    def _download(self, task, cancel):
+        if cancel.cancelled:
+            self._set_status(task, Status.CANCELLED)
+            return
+
+        if task.received:
+            # preempted before, get_file reports the resumed part again
+            self._advance(task, -task.received)
+
+        try:
+            if task.files:
+                status = self._fetch_archive(task, cancel)
+            else:
+                status = self._fetch(task, cancel)
+        except moodle.Cancelled:
+            if not self.cancel.cancelled:
+                # preempted by the scheduler, which runs it again later
+                self._set_status(task, Status.QUEUED)
+                raise
+
+            self._set_status(task, Status.CANCELLED)
+            return
+        except Exception as e:
+            log.error(f"cannot download {task.path.name}: {e}")
+            task.error = str(e)
+            self._set_status(task, Status.FAILED)
+            return
+
+        self._set_status(task, status)
+
+    def _fetch(self, task, cancel, owner=None):
+        """
+        Downloads the file of a task, progress is reported for the owner task
+        """
+        owner = owner or task
+        if self.manifest and self.manifest.unchanged(task):
+            self._advance(owner, task.filesize)
+            return Status.SKIPPED
+
+        status = Status.DONE
+        algorithm = self.manifest.algorithm if self.manifest else None
+        digest = self.store.lookup(task.url, task.timemodified) if self.store else None
+        if digest:
+            # the same file is already in the store
+            self.store.link(digest, task.path)
+            self._advance(owner, task.filesize)
+            status = Status.SKIPPED
+            if algorithm == self.store.ALGORITHM:
+                task.digest = f"{algorithm}:{digest}"
+            elif algorithm:
+                hasher = self.manifest.hasher()
+                moodle.hash_file(task.path, hasher)
+                task.digest = f"{algorithm}:{hasher.hexdigest()}"
+        else:
+            self._set_status(owner, Status.RUNNING)
+            task.path.parent.mkdir(parents=True, exist_ok=True)
+            hashers = {}
+            if self.store:
+                hashers[self.store.ALGORITHM] = self.store.hasher()
+            if algorithm and algorithm not in hashers:
+                hashers[algorithm] = self.manifest.hasher()
+
+            self.apihelper.get_file(task.url, task.path, cancel, progress=lambda n: self._advance(owner, n),
+                                    digest=_Digests(list(hashers.values())) if hashers else None)
+            if algorithm:
+                task.digest = f"{algorithm}:{hashers[algorithm].hexdigest()}"
+            if self.store:
+                self.store.add(task.path, hashers[self.store.ALGORITHM].hexdigest(), task.url, task.timemodified)
+
+        self._record(task)
+        return status
+
+    def _fetch_archive(self, task, cancel):
+        """
+        Downloads the files of a task at once as a zip archive, or one by one
+        if the archive is not available
+        """
+        if self.manifest and all(self.manifest.unchanged(f) for f in task.files):
+            self._advance(task, task.filesize)
+            return Status.SKIPPED
+
+        # the files are matched by their path in the archive
+        files = {f.path.relative_to(task.path).as_posix(): f for f in task.files}
+
+        def path_for(name):
+            entry = files.get("/".join(safe_name(p) for p in name.split("/") if p))
+            return entry.path if entry else None
+
+        self._set_status(task, Status.RUNNING)
+        extracted = {}
+        try:
+            extracted = self.apihelper.get_archive(task.url, functools.partial(
+                archive.extract, path_for=path_for, cancel=cancel, progress=lambda n: self._advance(task, n),
+                hasher=self.manifest.hasher if self.manifest and self.manifest.algorithm else None), cancel)
+        except moodle.Cancelled:
+            raise
+        except Exception as e:
+            log.warning(f"cannot download {task.path.name} as an archive, downloading its files: {e}")
+
+        # what was not in the archive is downloaded on its own
+        for f in task.files:
+            if f.path in extracted:
+                digest = extracted[f.path]
+                if digest:
+                    f.digest = f"{self.manifest.algorithm}:{digest.hexdigest()}"
+                self._record(f)
+            else:
+                self._fetch(f, cancel, task)
+
+        return Status.DONE
+
+    def _record(self, task):
+        if self.manifest:
+            if task.timemodified:
+                os.utime(task.path, (time.time(), task.timemodified))
+            self.manifest.record(task)
+
+    def _advance(self, task, nbytes):
+        # the segments of a file may progress in parallel
+        with self._lock:
+            task.received += nbytes
+            self._received += nbytes
+            received = self._received
+
+        if self.on_progress:
+            self.on_progress(received, self.total)
+
+    def _set_status(self, task, status):
+        task.status = status
+        log.debug(f"{task.path} is {status.value}")
+        if self.on_status:
+            self.on_status(task)
@@ -16,6 +16,10 @@ import html
 import logging
 import tempfile
 import code
+import time
+import collections
+import itertools
+import concurrent.futures
 
 from http.cookiejar import Cookie
 
@@ -38,6 +42,7 @@ from PyQt6.QtCore import (
     QSignalBlocker,
     QSortFilterProxyModel,
     QThread,
+    QTimer,
     Qt,
     QUrl,
     pyqtSignal,
@@ -66,11 +71,13 @@ from PyQt6.QtWidgets import (
     QWidget,
 )
 
-from PyQt6.QtWebEngineCore import (QWebEnginePage, QWebEngineProfile)
-from PyQt6.QtWebEngineWidgets import QWebEngineView
 from PyQt6.QtNetwork import QNetworkCookie
 
+from . import cache
+from . import download
+from . import metrics
 from . import moodle
+from . import sync
 
 
 log = logging.getLogger("muddle.gui")
@@ -134,41 +141,212 @@ class MoodleItem(QStandardItem):
 
 class MoodleFetcher(QThread):
     loadedItem = pyqtSignal(MoodleItem.Type, object)
+    # course id and timestamp of when its contents were fetched
+    syncedCourse = pyqtSignal(int, int)
+    # course id whose contents could not be fetched
+    failedCourse = pyqtSignal(int)
 
-    def __init__(self, parent, instanceUrl, token):
+    def __init__(self, parent, instanceUrl, token, apiOptions=None, workers=1, lastSync=None, stream=False, prefetch=0,
+                 timeout=None, batchSize=0):
         super().__init__()
 
-        self.api = moodle.RestApi(instanceUrl, token)
+        # cancels the whole refresh, also once the timeout expires
+        self.cancelToken = moodle.CancelToken(timeout)
+        self.api = moodle.RestApi(instanceUrl, token, cancel=self.cancelToken, **(apiOptions or {}))
         self.apihelper = moodle.ApiHelper(self.api)
+        self.workers = workers
+        self.lastSync = lastSync or {}
+        # decode the sections while they are downloaded
+        self.stream = stream
+        # number of courses fetched ahead of the one being emitted
+        self.prefetch = prefetch
+        # number of courses fetched with a single request
+        self.batchSize = batchSize
+        # the enrolled courses could not be fetched
+        self.failed = False
 
     def run(self):
-        for course in self.getCourses():
-            self.loadedItem.emit(MoodleItem.Type.COURSE, course)
-            for section in self.getSections(course):
-                self.loadedItem.emit(MoodleItem.Type.SECTION, section)
-                for module in self.getModules(section):
-                    self.loadedItem.emit(MoodleItem.Type.MODULE, module)
-                    for content in self.getContent(module):
-                        self.loadedItem.emit(MoodleItem.Type.CONTENT, content)
+        try:
+            self.fetch()
+        except moodle.Cancelled:
+            log.info("refresh was cancelled or took too long")
+
+    def cancel(self):
+        self.cancelToken.cancel()
+
+    def fetch(self):
+        courses = self.getCourses()
+        if courses is None:
+            self.failed = True
+            return
+
+        if self.workers > 1:
+            # fetch the contents in parallel, each course is emitted as soon
+            # as it is done so that items of a course still arrive in order
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                futures = {pool.submit(self.fetchCourse, c): c for c in courses}
+                for future in concurrent.futures.as_completed(futures):
+                    self.emitCourse(futures[future], *future.result())
+        elif self.batchSize > 1:
+            for i in range(0, len(courses), self.batchSize):
+                batch = courses[i:i + self.batchSize]
+                for course, result in zip(batch, self.fetchCourses(batch)):
+                    self.emitCourse(course, *result)
+
+        elif self.prefetch > 0:
+            # fetch the next courses in the background while the current one
+            # is being emitted, the order of the courses is kept
+            with concurrent.futures.ThreadPoolExecutor(self.prefetch) as pool:
+                pending = collections.deque()
+                for course in courses:
+                    pending.append((course, pool.submit(self.fetchCourse, course)))
+                    if len(pending) > self.prefetch:
+                        course, future = pending.popleft()
+                        self.emitCourse(course, *future.result())
+
+                for course, future in pending:
+                    self.emitCourse(course, *future.result())
+        else:
+            for course in courses:
+                self.emitCourse(course, *self.fetchCourse(course))
+
+    def fetchCourse(self, course):
+        """ Returns the fetch timestamp and the sections of a course, the
+        sections are None if the course did not change since the last sync,
+        both are None if the sections could not be fetched """
+        timestamp = int(time.time()) - moodle.SYNC_MARGIN
+        since = self.lastSync.get(course.get("id"))
+
+        if since is not None and self.api.supports("core_course_get_updates_since") is not False:
+            updated = self.apihelper.get_updates_since(course["id"], since)
+            if updated is not None and not updated:
+                log.debug(f"course {course['id']} did not change, not fetching")
+                return timestamp, None
+
+        sections = self.getSections(course)
+        if sections is None:
+            return None, None
+
+        if self.workers > 1 or self.prefetch > 0:
+            # a stream has to be read by the worker, not by the emitting thread
+            try:
+                sections = list(sections)
+            except moodle.MoodleException as e:
+                log.error(f"cannot get sections of course {course['id']}: {e}")
+                return None, None
+
+        return timestamp, sections
+
+    def fetchCourses(self, courses):
+        """ Same as fetchCourse for many courses, but with a request to check
+        for updates and a request to get the contents of all of them """
+        timestamp = int(time.time()) - moodle.SYNC_MARGIN
+        courses = [c for c in courses if "id" in c]
+
+        updates = {}
+        if self.api.supports("core_course_get_updates_since") is not False:
+            with self.api.batch() as batch:
+                updates = {
+                    c["id"]: batch.core_course_get_updates_since(courseid = c["id"], since = self.lastSync[c["id"]])
+                    for c in courses if c["id"] in self.lastSync
+                }
+
+        with self.api.batch() as batch:
+            contents = {}
+            for c in courses:
+                if c["id"] in updates:
+                    updated = moodle.ApiHelper.parse_updates(c["id"], updates[c["id"]].result())
+                    if updated is not None and not updated:
+                        log.debug(f"course {c['id']} did not change, not fetching")
+                        continue
+
+                contents[c["id"]] = batch.core_course_get_contents(courseid = str(c["id"]))
+
+        results = []
+        for c in courses:
+            if c["id"] in contents:
+                sections = self.sectionsFromResponse(contents[c["id"]].result())
+                results.append((timestamp, sections) if sections is not None else (None, None))
+            else:
+                results.append((timestamp, None))
+
+        return results
+
+    def emitCourse(self, course, timestamp, sections):
+        self.cancelToken.check()
+        if timestamp is None:
+            # the course keeps what was shown and the next refresh, which
+            # starts from the last successful one, fetches it again
+            if "id" in course:
+                self.failedCourse.emit(course["id"])
+            return
+
+        if sections is None:
+            self.syncedCourse.emit(course["id"], timestamp)
+            return
+
+        # a stream fails before its first section, the course is replaced
+        # only once that arrived
+        sections = iter(sections)
+        try:
+            first = list(itertools.islice(sections, 1))
+        except moodle.MoodleException as e:
+            log.error(f"cannot get sections of course {course.get('id')}: {e}")
+            if "id" in course:
+                self.failedCourse.emit(course["id"])
+            return
+
+        self.loadedItem.emit(MoodleItem.Type.COURSE, course)
+        for section in itertools.chain(first, sections):
+            self.loadedItem.emit(MoodleItem.Type.SECTION, section)
+            for module in self.getModules(section):
+                self.loadedItem.emit(MoodleItem.Type.MODULE, module)
+                for content in self.getContent(module):
+                    self.loadedItem.emit(MoodleItem.Type.CONTENT, content)
+
+        if "id" in course:
+            self.syncedCourse.emit(course["id"], timestamp)
 
     def getCourses(self):
+        """ Enrolled courses, None if they cannot be fetched """
         coursesReq = self.api.core_enrol_get_users_courses(userid = self.apihelper.get_userid())
         if not coursesReq:
-            return []
+            log.error("cannot get the enrolled courses")
+            return None
+
+        courses = coursesReq.json()
+        if not isinstance(courses, list):
+            log.error(f"cannot get the enrolled courses: {courses.get('message')}")
+            return None
 
-        return coursesReq.json()
+        return courses
 
     def getSections(self, course):
+        """ Sections of a course, None if they cannot be fetched """
         if not "id" in course:
             log.error("cannot get sections from invalid course (no id)")
             log.debug(course)
-            return []
+            return None
 
-        sectionsReq = self.api.core_course_get_contents(courseid = str(course["id"]))
+        sectionsReq = self.api.core_course_get_contents(courseid = str(course["id"]), _stream = self.stream)
         if not sectionsReq:
-            return []
+            return None
+
+        if self.stream:
+            return moodle.iter_json_array(sectionsReq, cancel = self.cancelToken, strict = True)
+
+        return self.sectionsFromResponse(sectionsReq)
+
+    def sectionsFromResponse(self, sectionsReq):
+        """ Sections in a response, None if the call failed """
+        if not sectionsReq:
+            return None
 
         sections = sectionsReq.json()
+        if not isinstance(sections, list):
+            log.error(f"cannot get sections: {sections.get('message')}")
+            return None
+
         return sections
 
     def getModules(self, section):
@@ -184,11 +362,115 @@ class MoodleFetcher(QThread):
             return []
 
 
+class MoodleDownloader(QThread):
+    # download.Task whose status changed and its new status, the task itself
+    # may have changed again by the time the signal is delivered
+    taskStatus = pyqtSignal(object, object)
+    # bytes received and total bytes of all the files
+    progress = pyqtSignal('qint64', 'qint64')
+    # number of tasks, known once the downloader runs
+    tasks = pyqtSignal(int)
+
+    def __init__(self, instanceUrl, token, files, apiOptions=None, helperOptions=None, scheduler=None, manifest=None,
+                 store=None, archives=None, web=None):
+        super().__init__()
+
+        self.cancelToken = moodle.CancelToken()
+        api = moodle.RestApi(instanceUrl, token, cancel=self.cancelToken, **(apiOptions or {}))
+        self.apihelper = moodle.ApiHelper(api, web=web, **(helperOptions or {}))
+        self.web = web
+        self.files = files
+        self.archives = archives or []
+        self.manager = download.DownloadManager(
+            self.apihelper,
+            cancel=self.cancelToken,
+            scheduler=scheduler,
+            on_status=lambda task: self.taskStatus.emit(task, task.status),
+            on_progress=self.progress.emit,
+            manifest=manifest,
+            store=store)
+
+    def run(self):
+        # asking the site whether it hands out autologin keys may need a
+        # request, which must not block the GUI
+        useArchives = bool(self.archives) and self.web is not None and bool(self.web.supported)
+
+        for url, path, filesize, timemodified in self.files:
+            self.manager.add(url, path, filesize, timemodified)
+
+        for moduleId, path, folderFiles in self.archives:
+            if useArchives:
+                self.manager.add_archive(self.apihelper.folder_archive_url(moduleId), path, folderFiles)
+            else:
+                for entry in folderFiles:
+                    self.manager.add(*entry)
+
+        self.tasks.emit(len(self.manager.tasks))
+        self.manager.run()
+
+    def cancel(self):
+        self.cancelToken.cancel()
+
+
+class MoodleOpener(QThread):
+    # bytes received and size of the file
+    progress = pyqtSignal('qint64', 'qint64')
+    # path of the downloaded file
+    downloaded = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, apihelper, scheduler, openCache, url, filename, filesize, timemodified):
+        super().__init__()
+
+        self.cancelToken = moodle.CancelToken()
+        self.apihelper = apihelper
+        self.scheduler = scheduler
+        self.openCache = openCache
+        self.url = url
+        self.filename = filename
+        self.filesize = filesize
+        self.timemodified = timemodified
+
+    def run(self):
+        if self.openCache:
+            path = self.openCache.path_for(self.url, self.filename)
+        else:
+            path = os.path.join(tempfile.gettempdir(), self.filename)
+
+        received = 0
+
+        def advance(nbytes):
+            nonlocal received
+            received += nbytes
+            self.progress.emit(received, self.filesize)
+
+        def fetch(cancel):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.apihelper.get_file(self.url, path, cancel, advance)
+
+        try:
+            self.scheduler.submit(fetch, download.Priority.INTERACTIVE, self.cancelToken).result()
+            if self.openCache:
+                self.openCache.put(self.url, self.filename, self.timemodified)
+        except Exception as e:
+            self.failed.emit(str(e) or type(e).__name__)
+            return
+
+        self.downloaded.emit(str(path))
+
+    def cancel(self):
+        self.cancelToken.cancel()
+
+
 class SwitchLoginDialog(QDialog):
     def __init__(self, parent, url):
         super().__init__(parent)
         self.setWindowTitle("SWICH AAI Login")
 
+        # the web engine is slow to load and rarely needed
+        from PyQt6.QtWebEngineCore import QWebEnginePage, QWebEngineProfile
+        from PyQt6.QtWebEngineWidgets import QWebEngineView
+
         self.webview = QWebEngineView(self)
         self.profile = QWebEngineProfile(self.webview)
         self.cookies = []
@@ -224,25 +506,59 @@ class MoodleTreeFilterModel(QSortFilterProxyModel):
 
 
 class MoodleTreeModel(QStandardItemModel):
-    def __init__(self):
+    refreshing = pyqtSignal(bool)
+
+    def __init__(self, apiOptions=None, fetchWorkers=1, incremental=False, streamContents=False, prefetchDepth=0,
+                 refreshTimeout=None, batchSize=0):
         super().__init__()
 
         self.setHorizontalHeaderLabels(["Item", "Size"])
         self.lastInsertedItem = None
         self.worker = None
+        # connection pool, cache, etc. shared by the workers' RestApi
+        self.apiOptions = apiOptions or {}
+        self.fetchWorkers = fetchWorkers
+        self.streamContents = streamContents
+        self.prefetchDepth = prefetchDepth
+        self.refreshTimeout = refreshTimeout
+        self.batchSize = batchSize
+
+        # in incremental mode only the courses that changed since their last
+        # sync are downloaded again, the others are kept as they are
+        self.incremental = incremental
+        self.lastSync = {}
+        self.syncedCourses = set()
+        self.failedCourses = set()
 
     @pyqtSlot(str, str)
     def refresh(self, instanceUrl, token):
         if not self.worker or self.worker.isFinished():
-            self.setRowCount(0) # instead of clear(), because clear() removes the headers
-
-            self.worker = MoodleFetcher(self, instanceUrl, token)
+            if not self.incremental:
+                self.setRowCount(0) # instead of clear(), because clear() removes the headers
+                self.lastSync = {}
+
+            self.syncedCourses = set()
+            self.failedCourses = set()
+            self.worker = MoodleFetcher(
+                self, instanceUrl, token, self.apiOptions, self.fetchWorkers, dict(self.lastSync),
+                self.streamContents, self.prefetchDepth, self.refreshTimeout, self.batchSize)
             self.worker.loadedItem.connect(self.onWorkerLoadedItem)
+            self.worker.syncedCourse.connect(self.onWorkerSyncedCourse)
+            self.worker.failedCourse.connect(self.onWorkerFailedCourse)
             self.worker.finished.connect(self.onWorkerDone)
             self.worker.start()
+            self.refreshing.emit(True)
         else:
             log.debug("A worker is already running, not refreshing")
 
+    @pyqtSlot()
+    def cancelRefresh(self):
+        if self.isRefreshing():
+            self.worker.cancel()
+
+    def isRefreshing(self):
+        return self.worker is not None and not self.worker.isFinished()
+
     @pyqtSlot(MoodleItem.Type, object)
     def onWorkerLoadedItem(self, type, item):
         # Assume that the items arrive in order
@@ -251,6 +567,11 @@ class MoodleTreeModel(QStandardItemModel):
 
         # if top level
         if type == MoodleItem.Type.COURSE:
+            # replace the old version of the course
+            oldItem = self.courseItem(item["id"])
+            if oldItem:
+                self.invisibleRootItem().removeRow(oldItem.row())
+
             moodleItem = MoodleItem(
                 parent = parent,
                 nodetype = type,
@@ -300,7 +621,10 @@ class MoodleTreeModel(QStandardItemModel):
                 parent = parent,
                 nodetype = contentType.get(item["type"]) or type,
                 title = item["filename"],
-                url = item["fileurl"])
+                url = item["fileurl"],
+                filepath = item.get("filepath", "/"),
+                filesize = item.get("filesize", 0),
+                timemodified = item.get("timemodified", 0))
 
         if not moodleItem:
             log.error(f"Could not load item of type {type}")
@@ -309,9 +633,39 @@ class MoodleTreeModel(QStandardItemModel):
         parent.insertRow(0, moodleItem)
         self.lastInsertedItem = moodleItem
 
+    @pyqtSlot(int, int)
+    def onWorkerSyncedCourse(self, courseId, timestamp):
+        self.lastSync[courseId] = timestamp
+        self.syncedCourses.add(courseId)
+
+    @pyqtSlot(int)
+    def onWorkerFailedCourse(self, courseId):
+        self.failedCourses.add(courseId)
+
     @pyqtSlot()
     def onWorkerDone(self):
         log.debug("worker done")
+        self.refreshing.emit(False)
+
+        # the courses that were not reached, or not even listed, are not gone
+        if self.worker.cancelToken.cancelled or self.worker.failed:
+            return
+
+        # remove the courses that are gone, e.g. if unenrolled
+        root = self.invisibleRootItem()
+        for row in reversed(range(root.rowCount())):
+            courseId = root.child(row).metadata.id
+            if courseId not in self.syncedCourses and courseId not in self.failedCourses:
+                root.removeRow(row)
+                self.lastSync.pop(courseId, None)
+
+    def courseItem(self, courseId):
+        root = self.invisibleRootItem()
+        for row in range(root.rowCount()):
+            if root.child(row).metadata.id == courseId:
+                return root.child(row)
+
+        return None
 
 
 class QLogHandler(QObject, logging.Handler):
@@ -334,6 +688,20 @@ class MuddleWindow(QMainWindow):
         self.instanceUrl = config["server"]["url"] if config.has_option("server", "url") else None
         self.token = config["server"]["token"] if config.has_option("server", "token") else None
 
+        # keep-alive connections, cached responses and limits shared by all
+        # the workers, see moodle.RestApi
+        self.apiOptions = sync.api_options(config)
+
+        ## large files may be downloaded with many connections
+        self.helperOptions = sync.helper_options(config)
+
+        ## double clicked files are downloaded in the background and cached
+        self.openCache = cache.FileCache.fromconfig(config)
+        self.openers = set()
+        # not the api of the refresh, which is cancelled with it
+        self.openHelper = moodle.ApiHelper(moodle.RestApi(self.instanceUrl, self.token, **self.apiOptions),
+                                           **self.helperOptions)
+
         # config tab
         ## TODO: when any of the settings change, update the values (but not in the config, yet)
 
@@ -377,9 +745,28 @@ class MuddleWindow(QMainWindow):
         self.logsTab = self.findChild(QPlainTextEdit, "logsTab")
         self.logsTab.setFont(f)
 
+        # stats tab
+        self.statsTab = self.findChild(QPlainTextEdit, "statsTab")
+        self.statsTab.setFont(f)
+
+        ## the metrics may also be exported for the prometheus node exporter
+        self.metricsFile = config.get("muddle", "metrics_file", fallback=None)
+
+        self.statsTimer = QTimer(self)
+        self.statsTimer.timeout.connect(self.onStatsTimerTimeout)
+        self.statsTimer.start(2000)
+
         # moodle tab
         ## set up proxymodel for moodle treeview
-        self.moodleTreeModel = MoodleTreeModel()
+        self.moodleTreeModel = MoodleTreeModel(
+            self.apiOptions,
+            config.getint("muddle", "fetch_workers", fallback=1),
+            config.getboolean("muddle", "incremental_refresh", fallback=False),
+            config.getboolean("muddle", "stream_contents", fallback=False),
+            config.getint("muddle", "prefetch_depth", fallback=0),
+            config.getfloat("muddle", "refresh_timeout", fallback=0) or None,
+            config.getint("muddle", "batch_size", fallback=0))
+        self.moodleTreeModel.refreshing.connect(self.onMoodleTreeModelRefreshing)
         self.moodleTreeModel.dataChanged.connect(self.onMoodleTreeModelDataChanged)
 
         self.filterModel = MoodleTreeFilterModel()
@@ -396,7 +783,7 @@ class MuddleWindow(QMainWindow):
         moodleTreeView.doubleClicked.connect(self.onMoodleTreeViewDoubleClicked)
 
         ## refresh moodle treeview
-        refreshBtn = self.findChild(QPushButton, "refreshBtn")
+        self.refreshBtn = refreshBtn = self.findChild(QPushButton, "refreshBtn")
         refreshBtn.clicked.connect(self.onRefreshBtnClicked)
 
         if not self.instanceUrl:
@@ -420,6 +807,24 @@ class MuddleWindow(QMainWindow):
         ## progressbar
         self.progressBar = self.findChild(QProgressBar, "downloadProgressBar")
 
+        ## download the checked files
+        self.downloader = None
+        ## all the downloads share the connection slots, opening a file goes first
+        self.scheduler = download.Scheduler(config.getint("muddle", "download_workers", fallback=4))
+        self.skipUnchanged = config.getboolean("muddle", "skip_unchanged", fallback=True)
+        self.hashAlgorithm = config.get("muddle", "hash_algorithm", fallback="sha256")
+        self.dedup = config.getboolean("muddle", "dedup", fallback=False)
+
+        ## folders are downloaded as a zip archive through the web pages of the
+        ## site, which need the private token to log in
+        self.archiveMinFiles = config.getint("muddle", "archive_min_files", fallback=10)
+        self.web = None
+        if self.instanceUrl and self.token and config.get("server", "private_token", fallback=None):
+            self.web = moodle.WebSession(moodle.RestApi(self.instanceUrl, self.token, **self.apiOptions),
+                                         config.get("server", "private_token"))
+        self.downloadBtn = self.findChild(QPushButton, "downloadBtn")
+        self.downloadBtn.clicked.connect(self.onDownloadBtnClicked)
+
         # self.moodleTreeModel.worker.loaded
         # self.moodleTreeModel.worker.loadedItem.connect(lambda t, item:)
 
@@ -440,11 +845,30 @@ class MuddleWindow(QMainWindow):
 
         self.show()
 
+    def closeEvent(self, event):
+        # the workers use the pool and the cache, which are closed below
+        if self.moodleTreeModel.worker:
+            self.moodleTreeModel.cancelRefresh()
+            self.moodleTreeModel.worker.wait()
+        if self.downloader:
+            self.downloader.cancel()
+            self.downloader.wait()
+        for opener in list(self.openers):
+            opener.cancel()
+            opener.wait()
+        if self.openCache:
+            self.openCache.close()
+        self.apiOptions["pool"].close()
+        if self.apiOptions["cache"]:
+            self.apiOptions["cache"].close()
+        super().closeEvent(event)
+
     @pyqtSlot(int)
     def setProgressBarTasks(self, nrTasks):
         self.progressBar.setMinimum(0)
-        self.progressBar.setMaximum(tasks)
+        self.progressBar.setMaximum(nrTasks)
         self.progressBar.reset()
+        self.progressBar.setValue(0)
 
     @pyqtSlot()
     def advanceProgressBar(self):
@@ -502,6 +926,42 @@ class MuddleWindow(QMainWindow):
     def onNewLogMessage(self, msg):
         self.logsTab.appendPlainText(msg)
 
+    @pyqtSlot()
+    def onStatsTimerTimeout(self):
+        stats = [metrics.registry.summary(), ""]
+
+        retry = self.apiOptions["retry"]
+        stats.append(f"retried calls: {retry.retries}")
+
+        limiter = self.apiOptions["limiter"]
+        if limiter:
+            stats.append(f"throttled calls: {limiter.throttled} ({limiter.throttled_time:.1f}s)")
+
+        responseCache = self.apiOptions["cache"]
+        if responseCache:
+            stats.append(f"cache hits: {responseCache.hits}, misses: {responseCache.misses}")
+
+        if self.openCache:
+            stats.append(f"opened files cache hits: {self.openCache.hits}, misses: {self.openCache.misses}")
+
+        stats.append(f"preempted downloads: {self.scheduler.preemptions}")
+        for priority, s in self.scheduler.stats().items():
+            if s["count"]:
+                stats.append(f"{priority.name.lower()} downloads: {s['count']}, waited {s['wait']:.2f}s "
+                             f"(max {s['max_wait']:.2f}s), took {s['time']:.2f}s on average")
+
+        # do not reset the scrollbars if nothing changed
+        text = "\n".join(stats)
+        if text != self.statsTab.toPlainText():
+            self.statsTab.setPlainText(text)
+
+        if self.metricsFile:
+            try:
+                metrics.registry.write_prometheus(self.metricsFile)
+            except OSError as e:
+                log.error(f"cannot write metrics to {self.metricsFile}: {e}")
+                self.metricsFile = None
+
     @pyqtSlot()
     def onDownloadPathEditEditingFinished(self):
         downloadPathEdit = self.findChild(QLineEdit, "downloadPathEdit")
@@ -523,12 +983,142 @@ class MuddleWindow(QMainWindow):
 
     @pyqtSlot()
     def onRefreshBtnClicked(self):
-        if self.instanceUrl and self.token:
+        if self.moodleTreeModel.isRefreshing():
+            self.moodleTreeModel.cancelRefresh()
+        elif self.instanceUrl and self.token:
             self.moodleTreeModel.refresh(self.instanceUrl, self.token)
         else:
             # TODO: implement error dialog
             pass
 
+    @pyqtSlot(bool)
+    def onMoodleTreeModelRefreshing(self, refreshing):
+        self.refreshBtn.setText("Stop" if refreshing else "Refresh")
+        if not refreshing:
+            self.downloadBtn.setEnabled(self.moodleTreeModel.rowCount() > 0)
+
+    @pyqtSlot()
+    def onDownloadBtnClicked(self):
+        if self.downloader and self.downloader.isRunning():
+            self.downloader.cancel()
+            return
+
+        files, archives = self.checkedFiles()
+        if not files and not archives:
+            self.statusBar().showMessage("No files selected", 5000)
+            return
+
+        log.info(f"downloading {len(files)} files and {len(archives)} folders to {self.downloadPath}")
+        manifest = download.Manifest(self.downloadPath, self.hashAlgorithm) if self.skipUnchanged else None
+        # in the download directory, because hardlinks cannot cross filesystems
+        store = download.BlobStore(os.path.join(self.downloadPath, ".muddle-store")) if self.dedup else None
+        self.downloader = MoodleDownloader(self.instanceUrl, self.token, files, self.apiOptions,
+                                           self.helperOptions, self.scheduler, manifest, store, archives, self.web)
+        self.downloader.tasks.connect(self.setProgressBarTasks)
+        self.downloader.taskStatus.connect(self.onDownloaderTaskStatus)
+        self.downloader.progress.connect(self.onDownloaderProgress)
+        self.downloader.finished.connect(self.onDownloaderFinished)
+
+        self.setProgressBarTasks(len(files) + len(archives))
+        self.downloadBtn.setText("Stop")
+        self.downloader.start()
+
+    def checkedFiles(self):
+        """
+        Files checked in the tree, with the path where they are saved, which
+        mirrors the course/section/module layout of the tree. Folders whose
+        files are all checked are downloaded as a zip archive if possible,
+        they are returned apart as (module id, path, files). Whether the site
+        supports it is decided by the downloader, see MoodleDownloader.run.
+        """
+        files = []
+        paths = set()
+        folders = collections.defaultdict(list)
+
+        def walk(item):
+            for row in range(item.rowCount()):
+                child = item.child(row)
+                if child.hasChildren():
+                    walk(child)
+                elif child.metadata.type == MoodleItem.Type.FILE and child.checkState() == Qt.CheckState.Checked:
+                    path = self.localPath(child)
+                    if path in paths:
+                        log.warning(f"skipping {child.metadata.url}, {path} is already downloaded")
+                        continue
+
+                    paths.add(path)
+                    entry = (child.metadata.url, path, child.metadata.filesize, child.metadata.timemodified)
+
+                    folder = child.parent()
+                    while folder and folder.metadata.type != MoodleItem.Type.FOLDER:
+                        folder = folder.parent()
+
+                    if folder and self.web:
+                        folders[folder].append(entry)
+                    else:
+                        files.append(entry)
+
+        def countFiles(item):
+            return sum(countFiles(item.child(row)) for row in range(item.rowCount())) \
+                + (item.metadata.type == MoodleItem.Type.FILE)
+
+        walk(self.moodleTreeModel.invisibleRootItem())
+
+        archives = []
+        for folder, folderFiles in folders.items():
+            if len(folderFiles) >= self.archiveMinFiles and len(folderFiles) == countFiles(folder):
+                archives.append((folder.metadata.id, self.localPath(folder), folderFiles))
+            else:
+                files.extend(folderFiles)
+
+        return files, archives
+
+    def localPath(self, item):
+        # files inside a folder may also be in subdirectories of the folder
+        parts = [p for p in getattr(item.metadata, "filepath", "").split("/") if p]
+        parts.append(item.metadata.title)
+
+        parent = item.parent()
+        while parent:
+            parts.insert(0, parent.metadata.title)
+            parent = parent.parent()
+
+        return os.path.join(self.downloadPath, *(download.safe_name(html.unescape(p)) for p in parts))
+
+    @pyqtSlot(object, object)
+    def onDownloaderTaskStatus(self, task, status):
+        if status == download.Status.DONE:
+            log.info(f"downloaded {task.path}")
+        elif status == download.Status.FAILED:
+            log.error(f"failed to download {task.path}: {task.error}")
+
+        if status not in (download.Status.QUEUED, download.Status.RUNNING):
+            self.advanceProgressBar()
+
+    @pyqtSlot('qint64', 'qint64')
+    def onDownloaderProgress(self, received, total):
+        manager = self.downloader.manager
+        done = manager.count(download.Status.DONE)
+        self.statusBar().showMessage(
+            f"Downloaded {done} of {len(manager.tasks)} files, "
+            f"{received / 2**20:.1f} of {total / 2**20:.1f} MiB")
+
+    @pyqtSlot()
+    def onDownloaderFinished(self):
+        manager = self.downloader.manager
+        done = manager.count(download.Status.DONE)
+        skipped = manager.count(download.Status.SKIPPED)
+        failed = manager.count(download.Status.FAILED)
+        message = f"Downloaded {done} of {len(manager.tasks)} files"
+        if skipped:
+            message += f", {skipped} were up to date"
+        if failed:
+            message += f", {failed} failed (see the logs)"
+
+        log.info(message)
+        self.statusBar().showMessage(message)
+        self.downloadBtn.setText("Download")
+
     @pyqtSlot()
     def updateDownloadPath(self, newpath):
         if not self.fileSystemModel.index(newpath).isValid():
@@ -548,17 +1138,38 @@ class MuddleWindow(QMainWindow):
         item = self.moodleTreeModel.itemFromIndex(realIndex)
 
         if item.metadata.type == MoodleItem.Type.FILE:
-            log.debug(f"started download from {item.metadata.url}")
+            filename = download.safe_name(html.unescape(item.metadata.title))
+            if self.openCache:
+                filepath = self.openCache.get(item.metadata.url, filename, item.metadata.timemodified)
+                if filepath:
+                    self.openFile(str(filepath))
+                    return
 
-            filepath = tempfile.gettempdir()+"/"+item.metadata.title
-            self.moodleTreeModel.worker.apihelper.get_file(item.metadata.url, filepath)
+            log.debug(f"started download from {item.metadata.url}")
+            opener = MoodleOpener(self.openHelper, self.scheduler, self.openCache, item.metadata.url, filename,
+                                  item.metadata.filesize, item.metadata.timemodified)
+            opener.progress.connect(lambda received, total: self.statusBar().showMessage(
+                f"Opening {filename}" + (f" ({100 * received // total}%)" if total else "")))
+            opener.downloaded.connect(self.onOpenerDownloaded)
+            opener.failed.connect(lambda error: log.error(f"cannot open {filename}: {error}"))
+            opener.finished.connect(lambda: self.openers.discard(opener))
+
+            # keep a reference until it is done
+            self.openers.add(opener)
+            opener.start()
 
-            if platform.system() == 'Darwin':       # macOS
-                subprocess.Popen(('open', filepath))
-            elif platform.system() == 'Windows':    # Windows
-                os.startfile(filepath)
-            else:                                   # linux variants
-                subprocess.Popen(('xdg-open', filepath))
+    @pyqtSlot(str)
+    def onOpenerDownloaded(self, filepath):
+        self.statusBar().clearMessage()
+        self.openFile(filepath)
+
+    def openFile(self, filepath):
+        if platform.system() == 'Darwin':       # macOS
+            subprocess.Popen(('open', filepath))
+        elif platform.system() == 'Windows':    # Windows
+            os.startfile(filepath)
+        else:                                   # linux variants
+            subprocess.Popen(('xdg-open', filepath))
 
     # this is here to emulate the behavior of setAutoTristate which does not
     # work because of a Qt Bug, see https://bugreports.qt.io/browse/QTBUG-59173
@@ -575,6 +1186,8 @@ class MuddleWindow(QMainWindow):
 
 
 def start(config):
+    # needed by the web engine, which is imported after the application is created
+    QApplication.setAttribute(Qt.ApplicationAttribute.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
     ex = MuddleWindow(config)
     sys.exit(app.exec())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import logging
+import os
+import pathlib
+import threading
+
+log = logging.getLogger("muddle.metrics")
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Series:
+    """
+    Counters of the calls to a single function of a host
+    """
+    def __init__(self):
+        self.count = 0
+        self.latency_sum = 0.0
+        # one more bucket for everything above the last bound (+Inf)
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sent = 0
+        self.received = 0
+        self.errors = {}
+
+    def observe(self, latency, sent, received, error):
+        self.count += 1
+        self.latency_sum += latency
+        self.sent += sent
+        self.received += received
+
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+        if error:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def todict(self):
+        return {
+            "count": self.count,
+            "latency_sum": self.latency_sum,
+            "buckets": list(self.buckets),
+            "sent": self.sent,
+            "received": self.received,
+            "errors": dict(self.errors),
+        }
+
+
+class Metrics:
+    """
+    Thread safe metrics of the calls made to Moodle, grouped by host and by
+    webservice function (downloads are recorded as the get_file function)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, host, function, latency, sent=0, received=0, error=None):
+        """
+        Records a call, error is the name of the class of error if it failed
+        """
+        with self._lock:
+            series = self._series.setdefault((host, function), Series())
+            series.observe(latency, sent, received, error)
+
+    def snapshot(self):
+        """
+        Returns a copy of the metrics as a dictionary indexed by the tuple
+        (host, function)
+        """
+        with self._lock:
+            return {key: s.todict() for key, s in self._series.items()}
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def summary(self):
+        """
+        Human readable table of the metrics
+        """
+        lines = [f"{'host':<24} {'function':<40} {'calls':>6} {'avg ms':>8} "
+                 f"{'sent':>10} {'received':>10} {'errors':>6}"]
+
+        for (host, function), s in sorted(self.snapshot().items()):
+            avg = 1000 * s["latency_sum"] / s["count"] if s["count"] else 0
+            errors = sum(s["errors"].values())
+            lines.append(f"{host:<24} {function:<40} {s['count']:>6} {avg:>8.0f} "
+                         f"{s['sent']:>10} {s['received']:>10} {errors:>6}")
+
+            for error, count in sorted(s["errors"].items()):
+                lines.append(f"{'':<24}   {error:<38} {count:>6}")
+
+        return "\n".join(lines)
+
+    def to_prometheus(self):
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+
+        def header(name, kind, text):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def labels(host, function, **extra):
+            pairs = dict(host=host, function=function, **extra)
+            escaped = (f'{k}="{_escape(v)}"' for k, v in pairs.items())
+            return "{" + ",".join(escaped) + "}"
+
+        header("muddle_calls_total", "counter", "Calls made to the Moodle server.")
+        for (host, function), s in snapshot:
+            lines.append(f"muddle_calls_total{labels(host, function)} {s['count']}")
+
+        header("muddle_call_errors_total", "counter", "Failed calls by class of error.")
+        for (host, function), s in snapshot:
+            for error, count in sorted(s["errors"].items()):
+                lines.append(f"muddle_call_errors_total{labels(host, function, error=error)} {count}")
+
+        header("muddle_call_duration_seconds", "histogram", "Duration of the calls.")
+        for (host, function), s in snapshot:
+            cumulative = 0
+            bounds = [str(b) for b in LATENCY_BUCKETS] + ["+Inf"]
+            for bound, count in zip(bounds, s["buckets"]):
+                cumulative += count
+                lines.append(f"muddle_call_duration_seconds_bucket{labels(host, function, le=bound)} {cumulative}")
+            lines.append(f"muddle_call_duration_seconds_sum{labels(host, function)} {s['latency_sum']}")
+            lines.append(f"muddle_call_duration_seconds_count{labels(host, function)} {s['count']}")
+
+        header("muddle_request_bytes_total", "counter", "Bytes sent to the server.")
+        for (host, function), s in snapshot:
+            lines.append(f"muddle_request_bytes_total{labels(host, function)} {s['sent']}")
+
+        header("muddle_response_bytes_total", "counter", "Bytes received from the server.")
+        for (host, function), s in snapshot:
+            lines.append(f"muddle_response_bytes_total{labels(host, function)} {s['received']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics for the textfile collector of the node exporter,
+        the file is replaced atomically so that it is never read half written
+        """
+        path = pathlib.Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(self.to_prometheus())
+        os.replace(tmp, path)
+        log.debug(f"wrote metrics to {path}")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# metrics of the whole process, used unless something else is given
+registry = Metrics()
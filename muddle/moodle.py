@@ -1,10 +1,29 @@
 #!/usr/bin/env python3
 import requests
+import requests.adapters
+import codecs
+import concurrent.futures
+import contextlib
+import hashlib
+import json
 import logging
+import os
+import pathlib
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import weakref
 import dataclasses
 
 from typing import List
 
+from . import metrics
+from . import paths
+
 log = logging.getLogger("muddle.moodle")
 
 
@@ -19,79 +38,1375 @@ def get_token(url, user, password):
     return requests.post(token_url, data=data)
 
 
+class SessionPool:
+    """
+    Keep-alive HTTP connection pool that can be shared between threads.
+
+    A requests.Session is not thread safe, so every thread gets its own
+    session, but they are all mounted on the same urllib3 pool, hence
+    connections to the server are reused regardless of the calling thread.
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=10, pool_block=False):
+        self._adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block)
+        self._local = threading.local()
+
+    @classmethod
+    def fromconfig(cls, config):
+        """
+        Creates a pool with the settings found in the [server] section
+        """
+        return cls(
+            pool_connections=config.getint("server", "pool_connections", fallback=4),
+            pool_maxsize=config.getint("server", "pool_maxsize", fallback=10),
+            pool_block=config.getboolean("server", "pool_block", fallback=False))
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", self._adapter)
+            session.mount("http://", self._adapter)
+            self._local.session = session
+
+        return session
+
+    def close(self):
+        self._adapter.close()
+
+
+class RetryPolicy:
+    """
+    Decides which failed calls are retried and how long to wait before
+    doing so. Only functions that read data are retried, with exponential
+    backoff and full jitter, unless the server asks for a specific delay.
+    """
+    # functions whose name matches are safe to call twice
+    READ_FUNCTIONS = re.compile(r"_(get|check|search)_")
+    # rate limited by the server, a retry is bound to fail
+    NEVER_RETRY = {"tool_mobile_get_autologin_key"}
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=30):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # for monitoring, a single policy may be shared by many threads
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fromconfig(cls, config):
+        """
+        Creates a policy with the settings found in the [server] section
+        """
+        return cls(
+            max_retries=config.getint("server", "max_retries", fallback=3),
+            backoff=config.getfloat("server", "retry_backoff", fallback=0.5))
+
+    def retryable(self, function):
+        return function not in self.NEVER_RETRY and bool(self.READ_FUNCTIONS.search(function))
+
+    def should_retry(self, function, attempt, response, idempotent=None):
+        """
+        The response is None if the connection failed, idempotent overrides
+        the guess based on the name of the function
+        """
+        if idempotent is None:
+            idempotent = self.retryable(function)
+
+        if attempt >= self.max_retries or not idempotent or function in self.NEVER_RETRY:
+            return False
+
+        return response is None or response.status_code in self.RETRY_STATUS
+
+    def delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(self.max_backoff, int(retry_after))
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def record(self):
+        """
+        Counts a retry
+        """
+        with self._lock:
+            self.retries += 1
+
+
+class TokenBucket:
+    """
+    Client side rate limiter, allows rate calls per second on average and
+    bursts of up to burst calls. The same bucket may be shared by many
+    threads, the calls are then limited all together.
+    """
+    def __init__(self, rate, burst=10):
+        self.rate = rate
+        self.burst = burst
+
+        # for monitoring
+        self.throttled = 0
+        self.throttled_time = 0
+
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fromconfig(cls, config):
+        """
+        Creates a limiter with the settings found in the [server] section,
+        returns None if calls should not be limited
+        """
+        rate = config.getfloat("server", "rate_limit", fallback=0)
+        if rate <= 0:
+            return None
+
+        return cls(rate, config.getint("server", "rate_burst", fallback=10))
+
+    def acquire(self):
+        """
+        Takes a token, waits if there are none left. Returns the time that
+        was spent waiting.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            # reserve the token now, so that waiting threads keep their turn
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+            if wait:
+                self.throttled += 1
+                self.throttled_time += wait
+
+        if wait:
+            time.sleep(wait)
+
+        return wait
+
+
+class MoodleException(Exception):
+    """
+    The webservice answered with an exception instead of a result
+    """
+    pass
+
+
+class Cancelled(Exception):
+    """
+    Raised when a call or a download is cancelled, or its deadline expired
+    """
+    pass
+
+
+class CancelToken:
+    """
+    Cancels calls and downloads from another thread, optionally with a
+    deadline after which everything is cancelled.
+
+    The responses that are being read while cancelling are shut down, so
+    the threads reading them wake up right away. A thread that is still
+    waiting for the response headers is only bounded by the call timeout.
+    """
+    def __init__(self, timeout=None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self._event = threading.Event()
+        # reentrant, a signal handler may cancel while its thread holds it
+        self._lock = threading.RLock()
+        self._responses = set()
+        self._children = weakref.WeakSet()
+
+    @property
+    def cancelled(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return True
+
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        with self._lock:
+            responses = list(self._responses)
+            children = list(self._children)
+
+        for r in responses:
+            _shutdown(r)
+
+        for child in children:
+            child.cancel()
+
+    def child(self):
+        """
+        Returns a token that is cancelled together with this one, but that
+        can also be cancelled on its own
+        """
+        token = CancelToken()
+        token.deadline = self.deadline
+        with self._lock:
+            self._children.add(token)
+
+        if self._event.is_set():
+            token.cancel()
+
+        return token
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    def timeout(self, timeout):
+        """
+        Returns the timeout reduced to the remaining time, raises if none
+        """
+        self.check()
+        if self.deadline is None:
+            return timeout
+
+        remaining = self.deadline - time.monotonic()
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def wait(self, seconds):
+        """
+        Sleeps, unless cancelled in the meantime
+        """
+        self._event.wait(self.timeout(seconds))
+        self.check()
+
+    def watch(self, response):
+        """
+        Context manager to shut down response if cancelled while using it
+        """
+        return _Watch(self, response)
+
+
+class _Watch:
+    def __init__(self, token, response):
+        self.token = token
+        self.response = response
+
+    def __enter__(self):
+        with self.token._lock:
+            self.token._responses.add(self.response)
+        # may have been cancelled before registering
+        self.token.check()
+        return self.response
+
+    def __exit__(self, exc_type, exc, tb):
+        with self.token._lock:
+            self.token._responses.discard(self.response)
+
+        # a shut down response fails with some connection error
+        if exc_type is not None and self.token.cancelled:
+            raise Cancelled() from exc
+
+
+def _shutdown(response):
+    # closing alone does not wake up a thread blocked in recv()
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    response.close()
+
+
+def _make_response(url, content, status_code=200):
+    """
+    Builds a requests.Response for a body that did not come from a request
+    (for example from the cache), so that callers do not see a difference
+    """
+    res = requests.Response()
+    res.url = url
+    res.status_code = status_code
+    res.encoding = "utf-8"
+    res._content = content
+    res._content_consumed = True
+    return res
+
+
+def _is_exception(content):
+    """
+    Moodle reports errors with a 200 status code and an exception object
+    """
+    return content.lstrip().startswith(b'{"exception"')
+
+
+def _exception_name(content):
+    try:
+        return json.loads(content).get("exception", "moodle_exception")
+    except ValueError:
+        return "moodle_exception"
+
+
+def _json_array(req):
+    """
+    Decoded body of a response that should be a JSON array, raises
+    MoodleException if there is no response or it is an exception
+    """
+    if req is None:
+        raise MoodleException("no response from the server")
+
+    data = req.json()
+    if isinstance(data, dict):
+        raise MoodleException(data.get("message") or data.get("exception"))
+    if not isinstance(data, list):
+        raise MoodleException(f"expected a JSON array, got {type(data).__name__}")
+
+    return data
+
+
+# structural characters outside of JSON strings, and the body of a string
+# up to the closing quote (escaped characters included)
+_JSON_STRUCTURE = re.compile(r'[\[\]{}"]')
+_JSON_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+
+
+def iter_json_array(response, chunk_size=64 * 1024, cancel=None, strict=False):
+    """
+    Incrementally decodes a streamed response that contains a JSON array of
+    objects, each object is yielded as soon as it has been received instead
+    of waiting for the whole body. Only one element is kept in memory.
+
+    If the response is not an array, e.g. a Moodle exception, nothing is
+    yielded or with strict MoodleException is raised.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    depth = 0
+    instring = False
+    notarray = False
+
+    with response, cancel.watch(response) if cancel else contextlib.nullcontext():
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            buf += decoder.decode(chunk)
+
+            while not notarray:
+                if instring:
+                    # stops early on a trailing backslash, whose escaped
+                    # character has not arrived yet
+                    pos = _JSON_STRING_BODY.match(buf, pos).end()
+                    if pos == len(buf) or buf[pos] != '"':
+                        break
+
+                    instring = False
+                    pos += 1
+                    continue
+
+                m = _JSON_STRUCTURE.search(buf, pos)
+                if not m:
+                    pos = len(buf)
+                    break
+
+                c, pos = m.group(), m.end()
+                if c == '"':
+                    instring = True
+
+                elif c in "[{":
+                    depth += 1
+                    if depth == 1 and c == "{":
+                        # not an array, most likely an exception, read it all
+                        notarray = True
+                        buf = buf[m.start():]
+                    elif depth == 1:
+                        buf, pos = buf[pos:], 0
+
+                else:
+                    depth -= 1
+                    if depth == 1:
+                        yield json.loads(buf[:pos].lstrip(" \t\r\n,"))
+                        buf, pos = buf[pos:], 0
+                    elif depth == 0:
+                        return
+
+    if notarray:
+        message = json.loads(buf).get("message")
+        if strict:
+            raise MoodleException(message)
+        log.error(f"expected a JSON array, got {message}")
+
+
 class RestApi:
     """
     Magic REST API wrapper (ab)using lambdas
+
+    Keyword arguments starting with an underscore are not sent to the
+    server but control the call itself:
+
+        _cache=False    do not use the response cache for this call
+        _stream=True    do not download the body yet, implies _cache=False
+        _timeout=10     seconds to wait for the server, instead of timeout
+        _cancel=token   CancelToken for this call, instead of cancel
+        _idempotent=b   whether the call may be retried, instead of guessing
+        _headers={...}  extra HTTP headers to send with this call
+
+    Calls that are cancelled or past the deadline of their token raise
+    Cancelled. Many calls can be sent at once with batch(). What the site
+    supports is known from a snapshot of its site info, see SiteSnapshot.
     """
-    def __init__(self, instance_url, token=None):
+    def __init__(self, instance_url, token=None, pool=None, cache=None, retry=None, limiter=None,
+                 metrics=metrics.registry, timeout=30, cancel=None, site_path=None,
+                 site_max_age=24 * 60 * 60):
         self._url = instance_url
-        if token:
-            self._token = token
+        self._host = urllib.parse.urlsplit(instance_url).hostname
+        self._token = token
+        # only close the pool on exit if it was created here
+        self._ownspool = pool is None
+        self._pool = pool or SessionPool()
+        self._cache = cache
+        self._retry = retry or RetryPolicy()
+        self._limiter = limiter
+        self._metrics = metrics
+        self._timeout = timeout
+        self._cancel = cancel
+        self._site = SiteSnapshot(self, site_path, site_max_age)
+        # None until it is known whether tool_mobile_call_external_functions works
+        self._batching = None
 
     def __getattr__(self, key):
-        return lambda **kwargs: RestApi._call(self._url, self._token, str(key), **kwargs)
+        # private names are never webservice functions, and without this
+        # copy / pickle would recurse forever before __init__ runs
+        if key.startswith("_"):
+            raise AttributeError(key)
 
-    def _call(self, function, **kwargs):
-        return RestApi._call(self._url, self._token, kwargs)
+        return lambda **kwargs: self._call(str(key), **kwargs)
 
-    @staticmethod
-    def _call(url, token, function, **kwargs):
-        api_url = f"{url}/webservice/rest/server.php?moodlewsrestformat=json"
-        data = {"wstoken": token, "wsfunction": function}
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def session(self):
+        return self._pool.session
+
+    def close(self):
+        if self._ownspool:
+            self._pool.close()
+
+    def batch(self):
+        return Batch(self)
+
+    @property
+    def site(self):
+        """
+        SiteInfo of the instance, None if it could not be retrieved
+        """
+        return self._site.get()
+
+    def supports(self, function):
+        """
+        Whether function is available, None if it is not known
+        """
+        site = self.site
+        return site.supports(function) if site else None
+
+    def _call(self, function, _cache=True, _stream=False, _timeout=None, _cancel=None, _idempotent=None,
+              _headers=None, **kwargs):
+        api_url = f"{self._url}/webservice/rest/server.php?moodlewsrestformat=json"
+        timeout = _timeout or self._timeout
+        cancel = _cancel or self._cancel
+
+        usecache = _cache and not _stream and self._cache is not None and self._cache.cacheable(function)
+        if usecache:
+            key = self._cache.key(self._url, self._token, function, kwargs)
+            body = self._cache.get(key, function)
+            if body is not None:
+                return _make_response(api_url, body)
+
+        data = {"wstoken": self._token, "wsfunction": function}
         for k, v in kwargs.items():
             data[str(k)] = v
 
         log.debug(f"calling api with POST to {api_url} with DATA {data}")
+        attempt = 0
+        while True:
+            if self._limiter:
+                self._limiter.acquire()
+
+            req = None
+            error = None
+            start = time.monotonic()
+            try:
+                if cancel:
+                    # read the body here, where it can be interrupted
+                    req = self.session.post(api_url, data=data, headers=_headers, stream=True,
+                                            timeout=cancel.timeout(timeout))
+                    if not _stream:
+                        with cancel.watch(req):
+                            req.content
+                else:
+                    req = self.session.post(api_url, data=data, headers=_headers, stream=_stream, timeout=timeout)
+
+                req.raise_for_status()
+
+                if not _stream and _is_exception(req.content):
+                    error = _exception_name(req.content)
+                elif usecache:
+                    self._cache.put(key, function, req.content)
+
+                return req
+
+            except requests.HTTPError:
+                error = f"HTTP {req.status_code}"
+                log.warning(f"Error code {req.status_code} returned by HTTP(s) request")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = type(e).__name__
+                req = None
+                log.error(f"Failed to connect for POST request:\n{str(e)}")
+            except Cancelled:
+                error = "Cancelled"
+                req = None
+                raise
+            finally:
+                self._observe(function, start, req, error, _stream)
+
+            if not self._retry.should_retry(function, attempt, req, _idempotent):
+                return req
+
+            delay = self._retry.delay(attempt, req)
+            self._retry.record()
+            attempt += 1
+            if req is not None:
+                # a streamed response holds its connection until closed
+                req.close()
+
+            log.info(f"retrying {function} in {delay:.2f}s (attempt {attempt})")
+            if cancel:
+                cancel.wait(delay)
+            else:
+                time.sleep(delay)
+
+    def _observe(self, function, start, req, error, stream):
+        if self._metrics is None:
+            return
+
+        sent, received = 0, 0
+        if req is not None:
+            sent = len(req.request.body or "")
+            # do not consume the body of a stream
+            received = int(req.headers.get("Content-Length", 0)) if stream else len(req.content)
+
+        self._metrics.observe(self._host, function, time.monotonic() - start, sent, received, error)
+
+
+class SiteSnapshot:
+    """
+    Site info (userid, version, available functions, limits) persisted on
+    disk, so that it is known at startup without a round trip. It is
+    fetched again once it is older than max_age seconds, if that fails the
+    old snapshot is kept.
+    """
+    def __init__(self, api, path=None, max_age=24 * 60 * 60):
+        self._api = api
+        self.max_age = max_age
+
+        if path is None:
+            # one per site and user
+            name = hashlib.sha256(f"{api._url} {api._token}".encode()).hexdigest()[:16]
+            path = paths.default_log_dir.joinpath(f"site-{name}.json")
+
+        self.path = pathlib.Path(path)
+        self.fetched = 0
+        self._info = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the SiteInfo, or None if it is not known
+        """
+        with self._lock:
+            if not self._loaded:
+                self._load()
+
+            if self._info is None or time.time() - self.fetched > self.max_age:
+                self._refresh()
+
+            return self._info
+
+    def invalidate(self):
+        with self._lock:
+            self.fetched = 0
+
+    def _load(self):
+        self._loaded = True
         try:
-            req = requests.post(api_url, data=data)
-            req.raise_for_status()
-        except requests.HTTPError:
-            log.warn("Error code returned by HTTP(s) request")
-        except (requests.ConnectionError, requests.Timeout, requests.ReadTimeout) as e:
-            log.error(f"Failed to connect for POST request:\n{str(e)}")
-        finally:
-            return req
+            snapshot = json.loads(self.path.read_text())
+            self._info = SiteInfo._fromdict(snapshot["info"])
+            self.fetched = snapshot["fetched"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+
+        log.debug(f"loaded site info from {self.path}")
+
+    def _refresh(self):
+        req = self._api.core_webservice_get_site_info(_cache=False)
+        if not req:
+            return
+
+        info = req.json()
+        if "userid" not in info:
+            log.error(f"cannot get site info: {info.get('message')}")
+            return
+
+        self._info = SiteInfo._fromdict(info)
+        self.fetched = time.time()
+
+        snapshot = {"fetched": self.fetched, "info": dataclasses.asdict(self._info)}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_text(json.dumps(snapshot))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning(f"cannot save site info to {self.path}: {e}")
+
+
+class Batch:
+    """
+    Collects many calls and sends them in a single request with
+    tool_mobile_call_external_functions. The calls return futures, whose
+    results are the same responses that the RestApi would give:
+
+        with api.batch() as batch:
+            a = batch.core_course_get_contents(courseid=1)
+            b = batch.core_course_get_contents(courseid=2)
+
+        sections = a.result().json()
+
+    If the site does not support batching the calls are made one by one.
+    Every call is also recorded in the metrics under its own function.
+    """
+    FUNCTION = "tool_mobile_call_external_functions"
+    # the function is missing or the token may not use it
+    UNSUPPORTED = {"webservice_access_exception", "dml_missing_record_exception"}
+
+    def __init__(self, api):
+        self._api = api
+        self._calls = []
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+
+        return lambda **kwargs: self._add(str(key), kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.send()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _add(self, function, kwargs):
+        future = concurrent.futures.Future()
+        self._calls.append((function, kwargs, future))
+        return future
+
+    def send(self):
+        calls, self._calls = self._calls, []
+        if not calls:
+            return
+
+        if self._api._batching is None:
+            self._api._batching = self._api.supports(self.FUNCTION)
+
+        if self._api._batching is not False:
+            if self._send_batch(calls):
+                self._api._batching = True
+                return
+
+        for function, kwargs, future in calls:
+            try:
+                future.set_result(self._api._call(function, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _send_batch(self, calls):
+        """
+        Returns False if the site could not run the batch at all, then the
+        calls have to be sent one by one
+        """
+        data = {}
+        for i, (function, kwargs, _) in enumerate(calls):
+            data[f"requests[{i}][function]"] = function
+            data[f"requests[{i}][arguments]"] = json.dumps(kwargs)
+
+        idempotent = all(self._api._retry.retryable(f) for f, _, _ in calls)
+        start = time.monotonic()
+        try:
+            req = self._api._call(self.FUNCTION, _idempotent=idempotent, **data)
+        except Exception as e:
+            for _, _, future in calls:
+                future.set_exception(e)
+            raise
+
+        if req is None or not req.ok:
+            # the server is unreachable, as with single calls
+            for _, _, future in calls:
+                future.set_result(req)
+            return True
+
+        responses = req.json()
+        if "responses" not in responses:
+            if responses.get("exception") in self.UNSUPPORTED:
+                log.info(f"{self.FUNCTION} is not available, sending calls one by one")
+                self._api._batching = False
+            else:
+                log.warning(f"batch failed, sending its calls one by one: {responses.get('message')}")
+            return False
+
+        elapsed = time.monotonic() - start
+        for i, ((function, _, future), res) in enumerate(zip(calls, responses["responses"])):
+            if res["error"]:
+                # the exception is JSON encoded too, report it like the rest
+                # server would have done
+                info = json.loads(res.get("exception") or "{}")
+                content = json.dumps({
+                    "exception": "moodle_exception",
+                    "errorcode": info.get("errorcode"),
+                    "message": info.get("message"),
+                }).encode()
+            else:
+                content = (res["data"] or "null").encode()
+
+            if self._api._metrics is not None:
+                self._api._metrics.observe(self._api._host, function, elapsed, len(data[f"requests[{i}][arguments]"]),
+                                           len(content), "moodle_exception" if res["error"] else None)
+            future.set_result(_make_response(req.url, content))
+
+        return True
 
 
 class MoodleInstance:
     """
     A more frendly API that wraps around the raw RestApi
     """
-    def __init__(self, url, token):
-        self.api = RestApi(url, token)
-        self.userid = None
+    def __init__(self, url, token, **options):
+        self.api = RestApi(url, token, **options)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.api.close()
 
     def get_userid(self):
-        if self.userid is None:
-            req = self.api.core_webservice_get_site_info()
-            self.userid = req.json()["userid"]
+        site = self.api.site
+        return site.userid if site else None
 
-        return self.userid
+    def site_info(self):
+        return self.api.site
 
     def get_enrolled_courses(self):
         req = self.api.core_enrol_get_users_courses(userid=self.get_userid())
-        for c in req.json():
+        for c in _json_array(req):
             yield Course._fromdict(c)
 
 
+class LoginError(Exception):
+    """
+    Raised when a WebSession cannot log in
+    """
+    pass
+
+
+class WebSession:
+    """
+    Session on the web pages of the site, for what the webservice API does
+    not offer, e.g. downloading a folder as a zip archive.
+
+    It logs in with an autologin key of the mobile app, which needs the
+    private token returned by login/token.php together with the token. Moodle
+    hands out a key only every few minutes, so a session should be shared.
+    """
+    FUNCTION = "tool_mobile_get_autologin_key"
+    # Moodle hands out keys and logs in with them only for its mobile app,
+    # which it recognizes by this in the user agent
+    USER_AGENT = "MoodleMobile (muddle)"
+
+    def __init__(self, api, private_token):
+        self.api = api
+        self.private_token = private_token
+        self.cookies = None
+        # do not ask for keys again and again if the first attempt failed
+        self._error = None
+        self._lock = threading.Lock()
+
+    @property
+    def supported(self):
+        """
+        Whether the site hands out autologin keys, None if it is not known
+        """
+        return bool(self.private_token) and self.api.supports(self.FUNCTION)
+
+    def login(self):
+        req = self.api.tool_mobile_get_autologin_key(privatetoken=self.private_token, _cache=False,
+                                                     _headers={"User-Agent": self.USER_AGENT})
+        data = req.json() if req else {}
+        if "key" not in data:
+            raise LoginError(f"cannot get an autologin key: {data.get('message')}")
+
+        r = self.api.session.get(data["autologinurl"], timeout=self.api._timeout,
+                                 headers={"User-Agent": self.USER_AGENT}, params={
+            "userid": self.api.site.userid,
+            "key": data["key"],
+            "urltogo": self.api._url,
+        })
+        r.raise_for_status()
+
+        self.cookies = requests.cookies.RequestsCookieJar()
+        for response in r.history + [r]:
+            self.cookies.update(response.cookies)
+
+        if "MoodleSession" not in self.cookies:
+            raise LoginError("the autologin did not start a session")
+
+        log.info("logged in to the web pages of the site")
+
+    def get(self, url, **kwargs):
+        """
+        GET request to a page of the site, logs in if needed
+        """
+        with self._lock:
+            if self._error:
+                raise self._error
+            if self.cookies is None:
+                try:
+                    self.login()
+                except LoginError as e:
+                    self._error = e
+                    raise
+            cookies = self.cookies
+
+        r = self.api.session.get(url, cookies=cookies, **kwargs)
+
+        # an expired session is redirected to the login page
+        if "/login/" in urllib.parse.urlsplit(r.url).path:
+            r.close()
+            with self._lock:
+                if self.cookies is cookies:
+                    self.login()
+                cookies = self.cookies
+
+            r = self.api.session.get(url, cookies=cookies, **kwargs)
+
+        return r
+
+
+# changes that happen while fetching, or a clock that is a bit off from the
+# server's one should not be missed by the next call of get_updates_since,
+# so the time of a sync is taken this many seconds earlier
+SYNC_MARGIN = 60
+
+
 class ApiHelper:
-    def __init__(self, api):
+    def __init__(self, api, segments=1, segment_threshold=64 * 1024 * 1024, web=None):
         self.api = api
+        # for the downloads that are not part of the webservice API
+        self.web = web
+        # files of at least segment_threshold bytes are downloaded with up to
+        # this many connections, see get_file()
+        self.segments = segments
+        self.segment_threshold = segment_threshold
 
     def get_userid(self):
-        req = self.api.core_webservice_get_site_info()
-        if req:
-            return req.json()["userid"]
-        else:
+        site = self.api.site
+        return site.userid if site else None
+
+    def get_updates_since(self, courseid, since):
+        """
+        Returns the ids of the modules of a course that changed after the
+        timestamp since, or None if the server could not tell
+        """
+        req = self.api.core_course_get_updates_since(courseid=courseid, since=int(since))
+        return self.parse_updates(courseid, req)
+
+    @staticmethod
+    def parse_updates(courseid, req):
+        """
+        Parses the response of core_course_get_updates_since, this is useful
+        if the call was made in a batch
+        """
+        if not req:
             return None
 
-    def get_file(self, url, local_path):
-        with requests.post(url, data={"token": self.api._token}, stream=True) as r:
-            r.raise_for_status()
-            with open(local_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+        updates = req.json()
+        if "instances" not in updates:
+            log.warning(f"cannot get updates of course {courseid}: {updates.get('message')}")
+            return None
+
+        return [i["id"] for i in updates["instances"] if i["contextlevel"] == "module"]
+
+    def get_file(self, url, local_path, cancel=None, progress=None, digest=None):
+        """
+        Downloads a file, the timeout of the api is the longest time to wait
+        for data (not for the whole file). If given, progress is called with
+        the number of bytes of every chunk that is written and digest (a
+        hashlib object) is updated with the whole content of the file.
+
+        The data is written to local_path.part and renamed to local_path once
+        complete. If the download fails or it is cancelled the .part file is
+        kept together with the validators sent by the server (see PartState),
+        so that the next call for the same url resumes it with a range request.
+
+        Large files are split in segments downloaded in parallel, if the
+        server supports range requests (see _get_segments).
+        """
+        cancel = cancel or self.api._cancel or CancelToken()
+        local_path = pathlib.Path(local_path)
+        part = local_path.with_name(local_path.name + ".part")
+        state = PartState.load(part, url)
+
+        segmented = bool(state and state.segments and part.exists())
+        offset = part.stat().st_size if state and part.exists() and not segmented else 0
+        headers = state.range_headers(offset) if state else {}
+
+        received = 0
+        lock = threading.Lock()
+        error = None
+        start = time.monotonic()
+
+        def advance(nbytes):
+            nonlocal received
+            with lock:
+                received += nbytes
+            if progress:
+                progress(nbytes)
+
+        try:
+            if segmented:
+                log.info(f"resuming the segments of {local_path.name}")
+                self._get_segments(url, part, state, cancel, advance, progress)
+            else:
+                r = self.api.session.post(url, data={"token": self.api._token}, headers=headers, stream=True,
+                                          timeout=cancel.timeout(self.api._timeout))
+                with cancel.watch(r):
+                    if offset and r.status_code == 416:
+                        r.close()
+                        if offset != state.size:
+                            # the file on the server is shorter than the part
+                            log.info(f"cannot resume {local_path.name}, starting over")
+                            state.remove()
+                            return self.get_file(url, local_path, cancel, progress, digest)
+
+                        # the part is already complete
+                        if progress:
+                            progress(offset)
+                        if digest:
+                            hash_file(part, digest)
+                    else:
+                        r.raise_for_status()
+
+                        if offset and _content_range_start(r) != offset:
+                            # the file changed or the server ignores ranges
+                            log.info(f"cannot resume {local_path.name}, starting over")
+                            offset = 0
+                        elif offset:
+                            log.info(f"resuming {local_path.name} at byte {offset}")
+
+                        state = PartState.fromresponse(part, url, r, offset)
+
+                        if not offset and self._segmentable(r, state):
+                            segmented = True
+                            state.segments = _split(state.size, self.segments)
+                            state.save()
+                            self._get_segments(url, part, state, cancel, advance, first=r)
+                        else:
+                            state.save()
+                            self._get_stream(r, part, state, offset, cancel, advance, progress, digest)
+
+            if segmented and digest:
+                hash_file(part, digest)
+
+            os.replace(part, local_path)
+            state.remove()
+
+        except Exception as e:
+            if isinstance(e, requests.HTTPError):
+                error = f"HTTP {e.response.status_code}"
+            else:
+                error = type(e).__name__
+
+            # without a way to resume the data is useless
+            if not (state and state.resumable):
+                if state:
+                    state.remove()
+                if part.exists():
+                    os.remove(part)
+            raise
+
+        finally:
+            if self.api._metrics is not None:
+                self.api._metrics.observe(
+                    urllib.parse.urlsplit(url).hostname, "get_file",
+                    time.monotonic() - start, 0, received, error)
+
+    def folder_archive_url(self, cmid):
+        return f"{self.api._url}/mod/folder/download_folder.php?id={cmid}"
+
+    def get_archive(self, url, extract, cancel=None):
+        """
+        Downloads a zip archive from a web page of the site and passes its
+        chunks to extract(chunks) while they are downloaded, see archive.extract
+        """
+        if not self.web:
+            raise LoginError("archives need a web session")
+        if not self.web.supported:
+            raise LoginError("the site does not hand out autologin keys")
+
+        cancel = cancel or self.api._cancel or CancelToken()
+        received = 0
+        error = None
+        start = time.monotonic()
+
+        def counted(chunks):
+            nonlocal received
+            for chunk in chunks:
+                cancel.check()
+                received += len(chunk)
+                yield chunk
+
+        try:
+            r = self.web.get(url, stream=True, timeout=cancel.timeout(self.api._timeout))
+            with cancel.watch(r):
+                r.raise_for_status()
+                if "zip" not in r.headers.get("Content-Type", ""):
+                    raise LoginError(f"{url} did not return an archive")
+
+                return extract(counted(iter_chunks(r)))
+
+        except Exception as e:
+            error = f"HTTP {e.response.status_code}" if isinstance(e, requests.HTTPError) else type(e).__name__
+            raise
+
+        finally:
+            if self.api._metrics is not None:
+                self.api._metrics.observe(
+                    urllib.parse.urlsplit(url).hostname, "get_archive",
+                    time.monotonic() - start, 0, received, error)
+
+    def _get_stream(self, r, part, state, offset, cancel, advance, progress, digest):
+        """
+        Appends the body of the response r to the part file
+        """
+        if offset and progress:
+            progress(offset)
+
+        if offset and digest:
+            hash_file(part, digest)
+
+        received = 0
+        with open(part, "ab" if offset else "wb") as f:
+            if state.size:
+                _preallocate(f, offset, state.size - offset)
+
+            for chunk in iter_chunks(r):
+                cancel.check()
+                f.write(chunk)
+                received += len(chunk)
+                if digest:
+                    digest.update(chunk)
+                advance(len(chunk))
+
+        # a cancelled or dropped connection may look like the end
+        cancel.check()
+        if state.size is not None and offset + received != state.size:
+            raise requests.ConnectionError(f"{part.name} is incomplete")
+
+    def _segmentable(self, r, state):
+        return (self.segments > 1 and r.status_code == 200 and state.size
+                and state.size >= self.segment_threshold
+                and r.headers.get("Accept-Ranges") == "bytes")
+
+    def _get_segments(self, url, part, state, cancel, advance, progress=None, first=None):
+        """
+        Downloads the segments of state in parallel, each with a range request
+        on its own connection, and writes them at their offset in the part
+        file. The first segment may be read from first, a response with the
+        whole file. The progress of the segments is saved in the state, so
+        they can be resumed.
+        """
+        done = sum(s[2] for s in state.segments)
+        if done and progress:
+            progress(done)
+
+        with open(part, "r+b" if part.exists() else "w+b") as f:
+            if os.fstat(f.fileno()).st_size < state.size:
+                f.truncate(state.size)
+            _preallocate(f, 0, state.size)
+
+        # the first failed segment stops the others
+        token = cancel.child()
+        lock = threading.Lock()
+        unsaved = 0
+        saved = time.monotonic()
+
+        def record(segment, done, nbytes):
+            nonlocal unsaved, saved
+            with lock:
+                segment[2] = done
+                unsaved += nbytes
+                if unsaved >= SEGMENTS_SAVE_BYTES or time.monotonic() - saved >= SEGMENTS_SAVE_TIME:
+                    state.save()
+                    unsaved, saved = 0, time.monotonic()
+
+        def fetch(segment, r=None):
+            begin, end, done = segment
+            if begin + done >= end:
+                return
+
+            if r is None:
+                headers = state.range_headers(begin + done)
+                headers["Range"] = f"bytes={begin + done}-{end - 1}"
+                r = self.api.session.post(url, data={"token": self.api._token}, headers=headers, stream=True,
+                                          timeout=token.timeout(self.api._timeout))
+                r.raise_for_status()
+                if _content_range_start(r) != begin + done:
+                    # the file changed, the segments are useless
+                    state.resumable = False
+                    raise requests.ConnectionError(f"cannot get the segment at {begin + done} of {part.name}")
+
+            position = begin + done
+            with token.watch(r), open(part, "r+b") as f:
+                f.seek(position)
+                for chunk in iter_chunks(r):
+                    token.check()
+                    chunk = chunk[:end - position]
+                    f.write(chunk)
+                    position += len(chunk)
+                    advance(len(chunk))
+
+                    # written data is saved before its progress
+                    f.flush()
+                    record(segment, position - begin, len(chunk))
+
+                    if position >= end:
+                        break
+
+                if r is first:
+                    # the rest of the file is for the other segments
+                    r.close()
+
+            token.check()
+            if position < end:
+                raise requests.ConnectionError(f"segment at {begin} of {part.name} is incomplete")
+
+        def run(segment, r=None):
+            try:
+                fetch(segment, r)
+            except Exception:
+                token.cancel()
+                raise
+
+        with concurrent.futures.ThreadPoolExecutor(len(state.segments)) as pool:
+            futures = [pool.submit(run, s, first if i == 0 else None) for i, s in enumerate(state.segments)]
+
+        # the progress since the last save, also of the failed segments
+        state.save()
+
+        # report the failure that stopped the others, not Cancelled
+        errors = [f.exception() for f in futures if f.exception()]
+        errors.sort(key=lambda e: isinstance(e, Cancelled))
+        if errors:
+            cancel.check()
+            raise errors[0]
+
+
+def _split(size, segments):
+    """
+    Splits size bytes in segments [begin, end, bytes done]
+    """
+    length = -(-size // segments)
+    return [[begin, min(size, begin + length), 0] for begin in range(0, size, length)]
+
+
+# bounds of the size of the chunks read by iter_chunks and the time that
+# reading a chunk should take, so that progress and cancelling stay responsive
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+CHUNK_TIME = 0.1
+
+# the progress of the segments is saved after this many bytes or seconds,
+# what is downloaded after the last save is downloaded again on resume
+SEGMENTS_SAVE_BYTES = 8 * 1024 * 1024
+SEGMENTS_SAVE_TIME = 1.0
+
+
+def iter_chunks(response):
+    """
+    Iterates over the body of a streamed response in chunks whose size adapts
+    to the speed of the connection. The chunks are views of a single buffer
+    that is overwritten by the next chunk, so they must be used right away.
+    """
+    buf = memoryview(bytearray(MAX_CHUNK))
+    size = MIN_CHUNK
+
+    # bodies without encoding are read straight into the buffer, without
+    # going through urllib3 (which would make a copy of every chunk)
+    fp = getattr(response.raw, "_fp", None)
+    if fp is None or not hasattr(fp, "readinto") or response.headers.get("Content-Encoding", "identity") != "identity":
+        for chunk in response.iter_content(chunk_size=size):
+            yield chunk
+        return
+
+    while True:
+        start = time.monotonic()
+        n = fp.readinto(buf[:size])
+        if not n:
+            break
+
+        yield buf[:n]
+
+        elapsed = time.monotonic() - start
+        if elapsed < CHUNK_TIME / 2 and n == size:
+            size = min(MAX_CHUNK, size * 2)
+        elif elapsed > CHUNK_TIME * 2:
+            size = max(MIN_CHUNK, size // 2)
+
+    # the whole body was read, so the connection can be reused
+    response.raw.release_conn()
+
+
+def _preallocate(f, offset, length):
+    """
+    Reserves the space for the rest of the file up front, to avoid
+    fragmentation. Only on linux, because elsewhere the size of the file
+    would change, breaking the resume of the download.
+    """
+    if length <= 0 or not sys.platform.startswith("linux"):
+        return
+
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        # FALLOC_FL_KEEP_SIZE
+        libc.fallocate(f.fileno(), 1, ctypes.c_longlong(offset), ctypes.c_longlong(length))
+    except (ImportError, OSError, AttributeError):
+        pass
+
+
+def hash_file(path, digest, chunk_size=1024 * 1024):
+    """
+    Updates the hashlib object digest with the content of the file at path
+    """
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-\d+/(\d+|\*)")
+
+
+def _content_range_start(response):
+    """
+    First byte of a partial response, None if the response is not partial
+    """
+    if response.status_code != 206:
+        return None
+
+    match = _CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+@dataclasses.dataclass
+class PartState:
+    """
+    Sidecar of a .part file, with what is needed to resume the download after
+    a restart of the process. It is saved as JSON next to the .part file.
+    """
+    path: pathlib.Path
+    url: str
+    etag: str = None
+    last_modified: str = None
+    size: int = None
+    resumable: bool = True
+    # [begin, end, bytes done] of a download in segments
+    segments: list = None
+
+    @property
+    def state_path(self):
+        return self.path.with_name(self.path.name + ".json")
+
+    @classmethod
+    def load(cls, path, url):
+        """
+        Returns the state of the .part file at path, or None if there is none
+        or it belongs to another url
+        """
+        try:
+            with open(path.with_name(path.name + ".json")) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("url") != url:
+            return None
+
+        return cls(path, url, data.get("etag"), data.get("last_modified"), data.get("size"),
+                   segments=data.get("segments"))
+
+    @classmethod
+    def fromresponse(cls, path, url, response, offset=0):
+        headers = response.headers
+        length = headers.get("Content-Length")
+
+        return cls(
+            path, url,
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+            size=offset + int(length) if length and length.isdigit() else None,
+            resumable=headers.get("Accept-Ranges", "bytes") != "none")
+
+    def range_headers(self, offset):
+        """
+        Headers that ask for the rest of the file, if it did not change
+        """
+        if not offset:
+            return {}
+
+        headers = {"Range": f"bytes={offset}-"}
+        # weak validators are not allowed in If-Range
+        if self.etag and not self.etag.startswith("W/"):
+            headers["If-Range"] = self.etag
+        elif self.last_modified:
+            headers["If-Range"] = self.last_modified
+
+        return headers
+
+    def save(self):
+        if not self.resumable:
+            self.remove()
+            return
+
+        data = {"url": self.url, "etag": self.etag, "last_modified": self.last_modified, "size": self.size,
+                "segments": self.segments}
+        tmp = self.state_path.with_name(self.state_path.name + ".tmp")
+        tmp.write_text(json.dumps(data))
+        os.replace(tmp, self.state_path)
+
+    def remove(self):
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
 
 
 # A bare minimum impl of Moodle SCHEMA
@@ -127,9 +1442,17 @@ class Course(SchemaObj):
     startdate: int
     enddate: int
 
-    def get_sections(self, api):
-        req = api.core_course_get_contents(courseid=self.id)
-        for s in req.json():
+    def get_sections(self, api, stream=False):
+        """
+        With stream the sections are decoded and yielded while the response
+        is still being downloaded, which helps with very large courses. If
+        the contents cannot be fetched MoodleException is raised
+        """
+        req = api.core_course_get_contents(courseid=self.id, _stream=stream)
+        if stream and req is None:
+            raise MoodleException("no response from the server")
+
+        for s in iter_json_array(req, strict=True) if stream else _json_array(req):
             # rest api response does not contain course id
             s["course"] = self.id
             yield Section._fromdict(s)
@@ -163,12 +1486,24 @@ class Module(SchemaObj):
     """
     id: int
     name: str
+    modname: str = ""
+    contents: List = dataclasses.field(default_factory=list)
+
+    def get_files(self):
+        for c in self.contents:
+            if c.get("type") == "file":
+                yield File._fromdict(c)
 
 
 @dataclasses.dataclass
 class File(SchemaObj):
     filename: str
     fileurl: str
+    type: str = "file"
+    # directory of the file inside a folder module
+    filepath: str = "/"
+    filesize: int = 0
+    timemodified: int = 0
 
 
 @dataclasses.dataclass
@@ -179,3 +1514,21 @@ class Folder(SchemaObj):
 @dataclasses.dataclass
 class ExternalLink(SchemaObj):
     pass
+
+
+@dataclasses.dataclass
+class SiteInfo(SchemaObj):
+    """
+    Information about the site and the user, from core_webservice_get_site_info
+    """
+    userid: int
+    sitename: str = ""
+    release: str = ""
+    version: str = ""
+    functions: List = dataclasses.field(default_factory=list)
+    downloadfiles: int = 0
+    uploadfiles: int = 0
+    usermaxuploadfilesize: int = -1
+
+    def supports(self, function):
+        return any(f["name"] == function for f in self.functions)
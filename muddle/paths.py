@@ -33,3 +33,6 @@ elif platform.system() == "Darwin":
 
 default_config_file = default_config_dir.joinpath("muddle.ini")
 default_log_file = default_log_dir.joinpath("muddle.log")
+default_cache_file = default_log_dir.joinpath("responses.sqlite")
+default_open_cache_dir = default_log_dir.joinpath("open")
+default_daemon_state_file = default_log_dir.joinpath("daemon.json")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Download of the courses without the graphical interface, this module must
+not import anything from Qt
+"""
+import html
+import logging
+import pathlib
+
+from . import cache
+from . import download
+from . import moodle
+
+log = logging.getLogger("muddle.sync")
+
+
+def api_options(config):
+    """
+    Options of moodle.RestApi from the [server] and [cache] sections
+    """
+    return {
+        "pool": moodle.SessionPool.fromconfig(config),
+        "cache": cache.ResponseCache.fromconfig(config),
+        "retry": moodle.RetryPolicy.fromconfig(config),
+        "limiter": moodle.TokenBucket.fromconfig(config),
+        "timeout": config.getfloat("server", "timeout", fallback=30),
+        "site_path": config.get("server", "site_info_file", fallback=None),
+        "site_max_age": config.getint("server", "site_info_max_age", fallback=24 * 60 * 60),
+    }
+
+
+def helper_options(config):
+    """
+    Options of moodle.ApiHelper from the [muddle] section
+    """
+    return {
+        "segments": config.getint("muddle", "download_segments", fallback=1),
+        "segment_threshold": config.getint("muddle", "segment_threshold", fallback=64) * 1024 * 1024,
+    }
+
+
+def course_files(course, sections, root):
+    """
+    Files of a course as (url, path, filesize, timemodified), the path under
+    root mirrors the course/section/module layout, as in the graphical interface
+    """
+    for section in sections:
+        for module in section.get_modules():
+            for f in module.get_files():
+                parts = [course.shortname, section.name, module.name]
+                parts.extend(p for p in f.filepath.split("/") if p)
+                parts.append(f.filename)
+
+                path = pathlib.Path(root).joinpath(*(download.safe_name(html.unescape(p)) for p in parts))
+                yield f.fileurl, path, f.filesize, f.timemodified
+
+
+class Sync:
+    """
+    Downloads the files of the enrolled courses into a directory. Files that
+    did not change since the last sync are skipped, see download.Manifest.
+    """
+    def __init__(self, config, root, courses=None, cancel=None, priority=download.Priority.BACKGROUND):
+        self.root = pathlib.Path(root)
+        # ids or short names of the courses to sync, all of them if empty
+        self.courses = set(courses or [])
+        self.cancel = cancel or moodle.CancelToken()
+        self.options = api_options(config)
+        self.instance = moodle.MoodleInstance(config["server"]["url"], config["server"]["token"],
+                                              cancel=self.cancel, **self.options)
+        self.apihelper = moodle.ApiHelper(self.instance.api, **helper_options(config))
+        self.scheduler = download.Scheduler(config.getint("muddle", "download_workers", fallback=4))
+        self.priority = priority
+        # short names of the courses whose files could not be listed by the
+        # last run, they are skipped
+        self.failed_courses = []
+
+        self.skip_unchanged = config.getboolean("muddle", "skip_unchanged", fallback=True)
+        self.hash_algorithm = config.get("muddle", "hash_algorithm", fallback="sha256")
+        self.dedup = config.getboolean("muddle", "dedup", fallback=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.instance.close()
+        self.options["pool"].close()
+        if self.options["cache"]:
+            self.options["cache"].close()
+
+    def selected(self, course):
+        return not self.courses or str(course.id) in self.courses or course.shortname in self.courses
+
+    def run(self, courses=None):
+        """
+        Downloads the files of courses, by default of the selected enrolled
+        courses. Returns the download.DownloadManager with the tasks.
+
+        Raises moodle.MoodleException if the enrolled courses cannot be
+        fetched, courses whose contents cannot be fetched are skipped and
+        listed in failed_courses.
+        """
+        if courses is None:
+            courses = [c for c in self.instance.get_enrolled_courses() if self.selected(c)]
+
+        manager = download.DownloadManager(
+            self.apihelper,
+            cancel=self.cancel,
+            scheduler=self.scheduler,
+            priority=self.priority,
+            on_status=self.on_status,
+            manifest=download.Manifest(self.root, self.hash_algorithm) if self.skip_unchanged else None,
+            store=download.BlobStore(self.root / ".muddle-store") if self.dedup else None)
+
+        paths = set()
+        self.failed_courses = []
+        for course in courses:
+            self.cancel.check()
+            log.info(f"listing the files of {course.shortname}")
+            try:
+                for url, path, filesize, timemodified in course_files(course, course.get_sections(self.instance.api),
+                                                                      self.root):
+                    if path in paths:
+                        log.warning(f"skipping {url}, {path} is already downloaded")
+                        continue
+
+                    paths.add(path)
+                    manager.add(url, path, filesize, timemodified)
+            except moodle.MoodleException as e:
+                log.error(f"cannot list the files of {course.shortname}, skipping it: {e}")
+                self.failed_courses.append(course.shortname)
+
+        manager.run()
+        return manager
+
+    def on_status(self, task):
+        if task.status == download.Status.DONE:
+            log.info(f"downloaded {task.path}")
+        elif task.status == download.Status.FAILED:
+            log.error(f"failed to download {task.path}: {task.error}")
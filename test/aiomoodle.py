@@ -0,0 +1,83 @@
+import pytest
+
+import asyncio
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web
+
+from muddle import aiomoodle
+
+
+def serve(handler, test):
+    """
+    Runs the coroutine test(url) against a local server whose webservice
+    calls are answered by handler(form)
+    """
+    calls = []
+
+    async def rest(request):
+        form = dict(await request.post())
+        calls.append(form)
+        status, body = handler(form)
+        return web.json_response(body, status=status)
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/webservice/rest/server.php", rest)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        try:
+            return await test(f"http://127.0.0.1:{runner.addresses[0][1]}")
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(main()), calls
+
+
+def test_call():
+    def handler(form):
+        return 200, {"function": form["wsfunction"], "args": sorted(form)}
+
+    async def test(url):
+        async with aiomoodle.AsyncRestApi(url, "token") as api:
+            return await api.core_course_get_contents(courseid=3, options=None)
+
+    result, calls = serve(handler, test)
+    assert result["function"] == "core_course_get_contents"
+    assert calls[0]["courseid"] == "3"
+    # None is left out, as requests does
+    assert "options" not in calls[0]
+
+
+def test_errors():
+    def handler(form):
+        if form["wsfunction"] == "core_enrol_get_users_courses":
+            return 500, {}
+        return 200, {"exception": "require_login_exception", "message": "Course not available"}
+
+    async def test(url):
+        async with aiomoodle.AsyncMoodleInstance(url, "token") as instance:
+            instance.userid = 7
+            courses = await instance.get_enrolled_courses()
+            sections = await instance.get_sections(aiomoodle.moodle.Course(3, "c", "c", "", 0, 0))
+            return courses, sections
+
+    assert serve(handler, test)[0] == ([], [])
+
+
+def test_get_userid():
+    answers = [(503, {}), (200, {"exception": "invalid_token"}), (200, {"userid": 7})]
+
+    def handler(form):
+        return answers.pop(0)
+
+    async def test(url):
+        async with aiomoodle.AsyncMoodleInstance(url, "token") as instance:
+            return [await instance.get_userid() for _ in range(4)]
+
+    # failures are not remembered, the user id is
+    result, calls = serve(handler, test)
+    assert result == [None, None, 7, 7]
+    assert len(calls) == 3
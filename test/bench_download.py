@@ -0,0 +1,86 @@
+"""
+Benchmark of ApiHelper.get_file against a local server, compared with the
+previous implementation that wrote chunks of 8 KiB. Run it with
+
+    PYTHONPATH=. python test/bench_download.py [size in MiB]
+
+The server runs in another process, so the CPU time is that of the client.
+"""
+import http.server
+import multiprocessing
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+from muddle import moodle
+
+BLOCK = os.urandom(1024 * 1024)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        size = int(self.path.strip("/"))
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(size * len(BLOCK)))
+        self.end_headers()
+        for _ in range(size):
+            self.wfile.write(BLOCK)
+
+
+def serve(port):
+    server = http.server.HTTPServer(("127.0.0.1", port.value), Handler)
+    port.value = server.server_port
+    server.serve_forever()
+
+
+def before(api, url, path):
+    r = api.session.post(url, data={"token": "token"}, stream=True)
+    with open(path, "wb") as f:
+        for chunk in r.iter_content(chunk_size=8192):
+            if chunk:
+                f.write(chunk)
+
+
+def after(api, url, path):
+    moodle.ApiHelper(api).get_file(url, path)
+
+
+def measure(name, download, api, url, path, size):
+    start, cpu = time.monotonic(), time.process_time()
+    download(api, url, path)
+    elapsed, cpu = time.monotonic() - start, time.process_time() - cpu
+
+    assert path.stat().st_size == size * len(BLOCK)
+    path.unlink()
+    print(f"{name:<8} {size / elapsed:8.0f} MiB/s {cpu / size * 1024:8.2f} CPU s/GiB")
+
+
+def main(size=512):
+    port = multiprocessing.Value("i", 0)
+    server = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    server.start()
+    while not port.value:
+        time.sleep(0.01)
+
+    url = f"http://127.0.0.1:{port.value}/{size}"
+    api = moodle.RestApi(f"http://127.0.0.1:{port.value}", "token", metrics=None)
+    path = pathlib.Path(tempfile.mkdtemp()) / "file"
+
+    for _ in range(2):
+        measure("before", before, api, url, path, size)
+        measure("after", after, api, url, path, size)
+
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,77 @@
+import pytest
+
+import time
+
+from muddle import cache
+
+
+@pytest.fixture
+def responses(tmp_path):
+    c = cache.ResponseCache(tmp_path / "responses.sqlite", max_size=100,
+                            ttl={"core_course_get_contents": 60})
+    yield c
+    c.close()
+
+
+def test_key_normalization():
+    a = cache.ResponseCache.key("url", "token", "core_course_get_contents", {"courseid": 1})
+    b = cache.ResponseCache.key("url", "token", "core_course_get_contents", {"courseid": "1"})
+    c = cache.ResponseCache.key("url", "other", "core_course_get_contents", {"courseid": 1})
+    assert a == b
+    assert a != c
+
+
+def test_hit_miss(responses):
+    assert responses.get("k", "core_course_get_contents") is None
+    responses.put("k", "core_course_get_contents", b"[]")
+    assert responses.get("k", "core_course_get_contents") == b"[]"
+    assert responses.stats == {"hits": 1, "misses": 1}
+
+
+def test_ttl(responses):
+    responses.ttl["core_course_get_contents"] = 0.01
+    responses.put("k", "core_course_get_contents", b"[]")
+    time.sleep(0.02)
+    assert responses.get("k", "core_course_get_contents") is None
+
+
+def test_lru_eviction(responses):
+    responses.put("a", "core_course_get_contents", b"x" * 40)
+    responses.put("b", "core_course_get_contents", b"x" * 40)
+    # make a more recently used than b
+    responses.get("a", "core_course_get_contents")
+    responses.put("c", "core_course_get_contents", b"x" * 40)
+
+    assert responses.get("a", "core_course_get_contents") is not None
+    assert responses.get("b", "core_course_get_contents") is None
+    assert responses.get("c", "core_course_get_contents") is not None
+
+
+def test_cacheable(responses):
+    assert responses.cacheable("core_webservice_get_site_info")
+    assert not responses.cacheable("core_course_get_updates_since")
+
+
+def test_file_cache(tmp_path):
+    files = cache.FileCache(tmp_path, max_size=10)
+
+    def download(url, filename, content, timemodified):
+        path = files.path_for(url, filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        files.put(url, filename, timemodified)
+        return path
+
+    a = download("a", "a.pdf", b"aaaa", 1)
+    assert files.get("a", "a.pdf", 1) == a
+    # changed on the server
+    assert files.get("a", "a.pdf", 2) is None
+
+    download("b", "b.pdf", b"bbbb", 1)
+    files.get("a", "a.pdf", 1)
+    download("c", "c.pdf", b"cccc", 1)
+
+    # b was opened least recently
+    assert files.get("b", "b.pdf", 1) is None
+    assert files.get("a", "a.pdf", 1) == a
+    assert not files.path_for("b", "b.pdf").exists()
@@ -0,0 +1,102 @@
+import pytest
+
+import ctypes
+import os
+import platform
+import subprocess
+import sys
+import types
+
+from muddle import daemon
+from muddle import download
+from muddle import moodle
+
+
+class FakeSyncer:
+    def __init__(self, root, courses, changes):
+        self.root = root
+        self.cancel = moodle.CancelToken()
+        self.courses = [moodle.Course(id, name, name, "", 0, 0) for id, name in courses]
+        # number of new files at every poll, by course id
+        self.changes = changes
+        self.runs = []
+        self.failed_courses = []
+
+        self.instance = types.SimpleNamespace(
+            api=types.SimpleNamespace(supports=lambda function: True),
+            get_enrolled_courses=lambda: iter(self.courses))
+        self.apihelper = types.SimpleNamespace(get_updates_since=self.get_updates_since)
+
+    def selected(self, course):
+        return True
+
+    def get_updates_since(self, courseid, since):
+        return list(range(self.changes[courseid]))
+
+    def run(self, courses):
+        manager = download.DownloadManager(None)
+        for course in courses:
+            self.runs.append(course.id)
+            for i in range(self.changes[course.id]):
+                manager.add(f"{course.id}/{i}", self.root / str(i)).status = download.Status.DONE
+
+        return manager
+
+
+def test_adaptive_polling(tmp_path):
+    syncer = FakeSyncer(tmp_path, [(1, "busy"), (2, "dormant")], {1: 3, 2: 0})
+    d = daemon.Daemon(syncer, tmp_path / "daemon.json", min_interval=10, max_interval=100)
+    d.refresh_courses()
+
+    for _ in range(4):
+        for state in list(d.states.values()):
+            d.poll(state)
+
+    busy, dormant = d.states[1], d.states[2]
+    assert busy.interval == 10 and busy.downloaded == 12
+    assert dormant.interval == 100
+    # dormant is synced once, then only asked for updates
+    assert syncer.runs.count(2) == 1
+
+    # the schedule survives a restart
+    state = daemon.read_state(tmp_path / "daemon.json")
+    assert state["courses"]["2"]["interval"] == 100
+    assert daemon.Daemon(syncer, tmp_path / "daemon.json").states[1].downloaded == 12
+    assert "dormant" in daemon.format_status(state)
+
+
+def test_running():
+    assert daemon.running({"pid": os.getpid(), "status": "idle"})
+    assert not daemon.running({"pid": os.getpid(), "status": "stopped"})
+
+    # a process that exited
+    p = subprocess.Popen([sys.executable, "-c", "pass"])
+    p.wait()
+    assert not daemon.running({"pid": p.pid, "status": "idle"})
+
+
+def test_running_windows(monkeypatch):
+    exit_codes = {10: 259, 11: 0}
+
+    class Kernel32:
+        def OpenProcess(self, access, inherit, pid):
+            return pid if pid in exit_codes else 0
+
+        def GetExitCodeProcess(self, handle, code):
+            code._obj.value = exit_codes[handle]
+            return 1
+
+        def CloseHandle(self, handle):
+            return 1
+
+    def kill(pid, sig):
+        raise AssertionError("signal 0 is Ctrl-C on Windows")
+
+    monkeypatch.setattr(platform, "system", lambda: "Windows")
+    monkeypatch.setattr(ctypes, "WinDLL", lambda name, use_last_error=False: Kernel32(), raising=False)
+    monkeypatch.setattr(ctypes, "get_last_error", lambda: 87, raising=False)
+    monkeypatch.setattr(os, "kill", kill)
+
+    assert daemon.running({"pid": 10, "status": "idle"})
+    assert not daemon.running({"pid": 11, "status": "idle"})
+    assert not daemon.running({"pid": 12, "status": "idle"})
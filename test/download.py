@@ -0,0 +1,198 @@
+import pytest
+
+import hashlib
+import io
+import threading
+import zipfile
+
+from muddle import download
+from muddle import moodle
+
+
+class FakeApiHelper:
+    def __init__(self, files):
+        self.files = files
+        self.requests = 0
+
+    def get_file(self, url, local_path, cancel=None, progress=None, digest=None):
+        self.requests += 1
+        if url not in self.files:
+            raise moodle.requests.HTTPError("404")
+
+        local_path.write_bytes(self.files[url])
+        if digest:
+            digest.update(self.files[url])
+        if progress:
+            progress(len(self.files[url]))
+
+
+def test_safe_name():
+    assert download.safe_name("a/b\\c: d?") == "a_b_c_ d_"
+    assert download.safe_name("notes.") == "notes"
+    assert download.safe_name("..") == "_"
+
+
+def test_download_manager(tmp_path):
+    helper = FakeApiHelper({"a": b"aaaa", "b": b"bb"})
+    statuses = []
+    progress = []
+
+    manager = download.DownloadManager(helper, workers=2,
+                                       on_status=lambda t: statuses.append((t.url, t.status)),
+                                       on_progress=lambda r, t: progress.append(r))
+    manager.add("a", tmp_path / "course" / "a.pdf", filesize=4)
+    manager.add("b", tmp_path / "course" / "section" / "b.pdf", filesize=2)
+    missing = manager.add("c", tmp_path / "c.pdf")
+
+    assert not manager.run()
+    assert (tmp_path / "course" / "section" / "b.pdf").read_bytes() == b"bb"
+    assert manager.count(download.Status.DONE) == 2
+    assert missing.status == download.Status.FAILED
+    assert max(progress) == 6
+    assert ("a", download.Status.RUNNING) in statuses
+
+
+def test_download_manager_cancelled(tmp_path):
+    cancel = moodle.CancelToken()
+    cancel.cancel()
+
+    manager = download.DownloadManager(FakeApiHelper({"a": b"a"}), cancel=cancel)
+    task = manager.add("a", tmp_path / "a")
+
+    assert not manager.run()
+    assert task.status == download.Status.CANCELLED
+    assert not (tmp_path / "a").exists()
+
+
+def test_skip_unchanged(tmp_path):
+    helper = FakeApiHelper({"a": b"aaaa"})
+
+    for _ in range(2):
+        manager = download.DownloadManager(helper, manifest=download.Manifest(tmp_path))
+        task = manager.add("a", tmp_path / "course" / "a.pdf", filesize=4, timemodified=1600000000)
+        assert manager.run()
+
+    assert helper.requests == 1
+    assert task.status == download.Status.SKIPPED
+    assert int(task.path.stat().st_mtime) == 1600000000
+    assert download.Manifest(tmp_path).get(task.path)["url"] == "a"
+
+    # a newer version on the server is downloaded again
+    manager = download.DownloadManager(helper, manifest=download.Manifest(tmp_path))
+    task = manager.add("a", tmp_path / "course" / "a.pdf", filesize=4, timemodified=1700000000)
+    assert manager.run()
+    assert helper.requests == 2
+
+
+def test_manifest_hash(tmp_path):
+    helper = FakeApiHelper({"a": b"aaaa", "b": b"bb"})
+    manager = download.DownloadManager(helper, manifest=download.Manifest(tmp_path, "blake2b"),
+                                       store=download.BlobStore(tmp_path / "store"))
+    a = manager.add("a", tmp_path / "a.pdf")
+    manager.add("b", tmp_path / "b.pdf")
+    assert manager.run()
+
+    manifest = download.Manifest(tmp_path)
+    assert manifest.get(a.path)["hash"] == "blake2b:" + hashlib.blake2b(b"aaaa").hexdigest()
+    assert manifest.verify() == []
+
+    (tmp_path / "b.pdf").unlink()
+    (tmp_path / "b.pdf").write_bytes(b"cc")
+    assert manifest.verify() == [tmp_path / "b.pdf"]
+
+
+def test_blob_store(tmp_path):
+    helper = FakeApiHelper({"a": b"same", "b": b"same", "c": b"other"})
+    store = download.BlobStore(tmp_path / "store")
+
+    manager = download.DownloadManager(helper, store=store)
+    a = manager.add("a", tmp_path / "1" / "a.pdf")
+    b = manager.add("b", tmp_path / "2" / "b.pdf")
+    c = manager.add("c", tmp_path / "2" / "c.pdf")
+    assert manager.run()
+
+    assert a.path.read_bytes() == b.path.read_bytes() == b"same"
+    assert a.path.stat().st_ino == b.path.stat().st_ino
+    assert a.path.stat().st_ino != c.path.stat().st_ino
+    assert len(list(store.objects.glob("*/*"))) == 2
+
+    # urls that were already seen are linked without a request
+    manager = download.DownloadManager(helper, store=download.BlobStore(tmp_path / "store"))
+    again = manager.add("a", tmp_path / "3" / "a.pdf")
+    assert manager.run()
+    assert helper.requests == 3
+    assert again.status == download.Status.SKIPPED
+    assert again.path.read_bytes() == b"same"
+
+
+def test_blob_store_unchanged(tmp_path):
+    helper = FakeApiHelper({"a": b"same", "b": b"same"})
+    store = download.BlobStore(tmp_path / "store")
+    links = []
+    link = store.link
+    store.link = lambda digest, path: links.append(path) or link(digest, path)
+
+    for _ in range(2):
+        manager = download.DownloadManager(helper, manifest=download.Manifest(tmp_path), store=store)
+        a = manager.add("a", tmp_path / "a.pdf", filesize=4, timemodified=1600000000)
+        b = manager.add("b", tmp_path / "b.pdf", filesize=4, timemodified=1700000000)
+        assert manager.run()
+
+    # the links share one modification time, but both are unchanged
+    assert a.path.stat().st_ino == b.path.stat().st_ino
+    assert a.status == b.status == download.Status.SKIPPED
+    assert helper.requests == 2
+    assert len(links) == 2
+
+
+def test_scheduler_preemption():
+    scheduler = download.Scheduler(slots=1)
+    started = threading.Event()
+    runs = []
+
+    def background(cancel):
+        runs.append("background")
+        started.set()
+        for _ in range(100):
+            cancel.wait(0.01)
+        return "background"
+
+    slow = scheduler.submit(background, download.Priority.BACKGROUND)
+    started.wait()
+    fast = scheduler.submit(lambda cancel: "interactive", download.Priority.INTERACTIVE)
+
+    assert fast.result(timeout=1) == "interactive"
+    assert slow.result(timeout=5) == "background"
+    assert runs == ["background", "background"]
+    assert scheduler.preemptions == 1
+    assert scheduler.stats()[download.Priority.INTERACTIVE]["max_wait"] < 0.5
+
+
+def test_archive(tmp_path):
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("/a.pdf", b"a" * 1000)
+        z.writestr("/sub/b:c.pdf", b"b")
+        z.writestr("/unknown.pdf", b"?")
+
+    class ArchiveApiHelper(FakeApiHelper):
+        def get_archive(self, url, extract, cancel=None):
+            data = content.getvalue()
+            return extract(data[i:i + 100] for i in range(0, len(data), 100))
+
+    helper = ArchiveApiHelper({"missing": b"m"})
+    folder = tmp_path / "folder"
+    manager = download.DownloadManager(helper)
+    task = manager.add_archive("archive", folder, [
+        ("a", folder / "a.pdf", 1000, 0),
+        ("b", folder / "sub" / "b_c.pdf", 1, 0),
+        ("missing", folder / "missing.pdf", 1, 0),
+    ])
+
+    assert manager.run()
+    assert task.status == download.Status.DONE
+    assert (folder / "a.pdf").read_bytes() == b"a" * 1000
+    assert (folder / "sub" / "b_c.pdf").read_bytes() == b"b"
+    assert not (folder / "unknown.pdf").exists()
+    # only the file that was not in the archive is downloaded on its own
+    assert helper.requests == 1
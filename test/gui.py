@@ -0,0 +1,245 @@
+import pytest
+
+import json
+import os
+import threading
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+QtWidgets = pytest.importorskip("PyQt6.QtWidgets")
+from PyQt6.QtCore import QEventLoop
+
+from muddle import download
+from muddle import gui
+from muddle import moodle
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def wait(thread):
+    """
+    Runs the event loop until thread finishes, delivering its signals
+    """
+    loop = QEventLoop()
+    thread.finished.connect(loop.quit)
+    thread.start()
+    loop.exec()
+    QtWidgets.QApplication.processEvents()
+
+
+class FastApiHelper:
+    def get_file(self, url, local_path, cancel=None, progress=None, digest=None):
+        local_path.write_bytes(url.encode())
+
+
+def test_downloader_task_status(app, tmp_path):
+    downloader = gui.MoodleDownloader("https://moodle.example.com", "token",
+                                      [(str(i), tmp_path / str(i), 0, 0) for i in range(20)])
+    downloader.manager.apihelper = FastApiHelper()
+    statuses = []
+    downloader.taskStatus.connect(lambda task, status: statuses.append((task.url, status)))
+
+    wait(downloader)
+    # every change is delivered with the status it had, not the one the
+    # task has once the signal arrives
+    assert [s for _, s in statuses].count(download.Status.DONE) == 20
+    assert [s for _, s in statuses].count(download.Status.RUNNING) == 20
+
+
+@pytest.mark.parametrize("supported", [True, False])
+def test_downloader_archives(app, tmp_path, supported):
+    threads = []
+
+    class Web:
+        @property
+        def supported(self):
+            threads.append(threading.current_thread())
+            return supported
+
+    folder = [(f"f{i}", tmp_path / "folder" / str(i), 0, 0) for i in range(3)]
+    downloader = gui.MoodleDownloader("https://moodle.example.com", "token", [("a", tmp_path / "a", 0, 0)],
+                                      archives=[(7, tmp_path / "folder", folder)], web=Web())
+    downloader.manager.apihelper = FastApiHelper()
+    downloader.manager.apihelper.get_archive = lambda url, extract, cancel=None: {}
+    tasks = []
+    downloader.tasks.connect(tasks.append)
+
+    wait(downloader)
+    # asked by the downloader, not by the GUI thread
+    assert threads and threading.main_thread() not in threads
+    assert tasks == [2 if supported else 4]
+    assert all((tmp_path / "folder" / str(i)).exists() for i in range(3))
+
+
+class FakeMoodle:
+    """
+    Pool whose session answers the webservice calls with handlers[function],
+    which return a JSON-able body or None for a server that cannot be reached
+    """
+    def __init__(self, courses):
+        self.session = self
+        self.courses = courses
+        self.calls = []
+        self._lock = threading.Lock()
+        self.handlers = {
+            "core_webservice_get_site_info": lambda: {"userid": 2, "functions": []},
+            "core_enrol_get_users_courses": lambda: [
+                {"id": id, "shortname": f"course{id}"} for id in self.courses],
+            "core_course_get_contents": lambda courseid: [
+                {"id": int(courseid) * 10, "name": f"section of {courseid}", "modules": []}],
+        }
+
+    def post(self, url, data=None, **kwargs):
+        data = dict(data)
+        function = data.pop("wsfunction")
+        data.pop("wstoken")
+        data.pop("userid", None)
+        with self._lock:
+            self.calls.append((function, data))
+
+        body = self.handlers[function](**data)
+        if body is None:
+            raise moodle.requests.ConnectionError("unreachable")
+        return moodle._make_response(url, json.dumps(body).encode())
+
+    def close(self):
+        pass
+
+
+def tree_model(tmp_path, site, **options):
+    apiOptions = {"pool": site, "site_path": tmp_path / "site.json", "metrics": None,
+                  "retry": moodle.RetryPolicy(max_retries=0)}
+    return gui.MoodleTreeModel(apiOptions, incremental=True, **options)
+
+
+def refresh(model):
+    model.refresh("https://moodle.example.com", "token")
+    loop = QEventLoop()
+    model.worker.finished.connect(loop.quit)
+    if not model.worker.isFinished():
+        loop.exec()
+    QtWidgets.QApplication.processEvents()
+
+
+def course_ids(model):
+    root = model.invisibleRootItem()
+    return sorted(root.child(row).metadata.id for row in range(root.rowCount()))
+
+
+@pytest.mark.parametrize("answer", [None, {"exception": "invalid_token", "message": "Invalid token"}])
+def test_refresh_courses_failed(app, tmp_path, answer):
+    site = FakeMoodle([1, 2])
+    model = tree_model(tmp_path, site)
+    refresh(model)
+    assert course_ids(model) == [1, 2]
+
+    # the courses are kept, and so is the time of their last sync
+    site.handlers["core_enrol_get_users_courses"] = lambda: answer
+    refresh(model)
+    assert model.worker.failed
+    assert course_ids(model) == [1, 2]
+    assert set(model.lastSync) == {1, 2}
+
+
+class SlowContents:
+    """
+    Contents of the courses that take delays[courseid] seconds, or until
+    released, recording how many are fetched at once
+    """
+    def __init__(self, delays):
+        self.delays = delays
+        self.release = threading.Event()
+        self.active = 0
+        self.most = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, courseid):
+        courseid = int(courseid)
+        with self._lock:
+            self.active += 1
+            self.most = max(self.most, self.active)
+        try:
+            self.release.wait(self.delays.get(courseid, 5))
+        finally:
+            with self._lock:
+                self.active -= 1
+
+        return [{"id": courseid * 10, "name": f"section of {courseid}", "modules": [
+            {"id": courseid * 100, "name": "slides", "modname": "resource", "contents": [
+                {"type": "file", "filename": f"{courseid}.pdf", "fileurl": f"{courseid}.pdf"}]}]}]
+
+
+def emitted(model):
+    """
+    Course ids of the items emitted by the worker of model, in order
+    """
+    items = []
+    model.worker.loadedItem.connect(
+        lambda type, item: items.append(item["id"] if type == gui.MoodleItem.Type.COURSE
+                                        else item.get("id", item.get("fileurl"))))
+    return items
+
+
+def course_of(item):
+    # see SlowContents, the ids of the items are derived from their course
+    if isinstance(item, str):
+        return int(item.split(".")[0])
+    return item if item < 10 else item // 10 if item < 100 else item // 100
+
+
+@pytest.mark.parametrize("options", [{"fetchWorkers": 3}, {"prefetchDepth": 2}])
+def test_refresh_concurrent(app, tmp_path, options):
+    courses = list(range(1, 7))
+    site = FakeMoodle(courses)
+    # the first course is the slowest
+    contents = SlowContents({c: 0.3 if c == 1 else 0.05 for c in courses})
+    site.handlers["core_course_get_contents"] = contents
+    model = tree_model(tmp_path, site, **options)
+
+    model.refresh("https://moodle.example.com", "token")
+    items = emitted(model)
+    loop = QEventLoop()
+    model.worker.finished.connect(loop.quit)
+    loop.exec()
+    QtWidgets.QApplication.processEvents()
+
+    assert course_ids(model) == courses
+    assert contents.most > 1
+    assert contents.most <= options.get("fetchWorkers", options.get("prefetchDepth", 0) + 1)
+
+    # the items of a course are emitted together, after the course
+    order = [course_of(i) for i in items]
+    runs = [c for i, c in enumerate(order) if i == 0 or order[i - 1] != c]
+    assert sorted(runs) == courses
+    if "prefetchDepth" in options:
+        # the courses keep their order
+        assert runs == courses
+    else:
+        # the slow course does not hold back the others
+        assert runs[-1] == 1
+
+
+@pytest.mark.parametrize("options", [{"fetchWorkers": 3}, {"prefetchDepth": 2}])
+def test_refresh_concurrent_cancelled(app, tmp_path, options):
+    site = FakeMoodle(list(range(1, 11)))
+    contents = SlowContents({})
+    site.handlers["core_course_get_contents"] = contents
+    model = tree_model(tmp_path, site, **options)
+
+    model.refresh("https://moodle.example.com", "token")
+    deadline = time.monotonic() + 5
+    while contents.active < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    model.cancelRefresh()
+    contents.release.set()
+    model.worker.wait()
+    QtWidgets.QApplication.processEvents()
+
+    # the courses that were waiting are not fetched anymore
+    fetched = [c for c in site.calls if c[0] == "core_course_get_contents"]
+    assert 2 <= len(fetched) <= 3
+    assert course_ids(model) == []
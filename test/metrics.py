@@ -0,0 +1,31 @@
+import pytest
+
+from muddle import metrics
+
+
+def test_observe():
+    m = metrics.Metrics()
+    m.observe("moodle", "core_course_get_contents", 0.2, 10, 100)
+    m.observe("moodle", "core_course_get_contents", 100, 10, 0, "ConnectionError")
+
+    s = m.snapshot()[("moodle", "core_course_get_contents")]
+    assert s["count"] == 2
+    assert s["sent"] == 20
+    assert s["received"] == 100
+    assert s["errors"] == {"ConnectionError": 1}
+    # one in the 0.25 bucket, one above all the bounds
+    assert s["buckets"][2] == 1
+    assert s["buckets"][-1] == 1
+
+
+def test_prometheus(tmp_path):
+    m = metrics.Metrics()
+    m.observe("moodle", "get_file", 0.01, 0, 42, 'HTTP "404"')
+
+    text = m.to_prometheus()
+    assert 'muddle_calls_total{host="moodle",function="get_file"} 1' in text
+    assert 'muddle_call_duration_seconds_bucket{host="moodle",function="get_file",le="+Inf"} 1' in text
+    assert 'error="HTTP \\"404\\""' in text
+
+    m.write_prometheus(tmp_path / "muddle.prom")
+    assert (tmp_path / "muddle.prom").read_text() == text
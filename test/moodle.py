@@ -1,22 +1,31 @@
 import pytest
 
+import hashlib
+import http.server
+import json
 import pathlib
 import configparser
+import threading
+import time
 
+from muddle import download
+from muddle import metrics
 from muddle import paths
 from muddle import moodle
 
 config_file = pathlib.Path(paths.default_config_file)
-if not config_file.is_file():
-    log.error(f"cannot read {config_file}")
-    sys.exit(1)
-
 config = configparser.ConfigParser()
 config.read(config_file)
 
+# tests that talk to a real server need a configured muddle.ini
+live = pytest.mark.skipif(not config.has_option("server", "token"),
+                          reason=f"cannot read {config_file}")
+
 
+@live
 class TestMoodleInstance:
-    server = moodle.MoodleInstance(config["server"]["url"], config["server"]["token"])
+    server = moodle.MoodleInstance(config.get("server", "url", fallback=None),
+                                   config.get("server", "token", fallback=None))
 
     def test_get_userid(self):
         assert self.server.get_userid() != None
@@ -25,6 +34,7 @@ class TestMoodleInstance:
         assert type(next(self.server.get_enrolled_courses())) == moodle.Course
 
 
+@live
 def test_moodle_api():
     server = moodle.MoodleInstance(config["server"]["url"], config["server"]["token"])
 
@@ -34,3 +44,488 @@ def test_moodle_api():
             print(section.name)
             for module in section.get_modules():
                 print(module.name)
+
+
+def test_retry_policy():
+    policy = moodle.RetryPolicy(max_retries=2, backoff=1, max_backoff=3)
+
+    assert policy.should_retry("core_course_get_contents", 0, None)
+    assert not policy.should_retry("core_course_get_contents", 2, None)
+    # functions that write must not be sent twice
+    assert not policy.should_retry("core_course_view_course", 0, None)
+    # one key every few minutes
+    assert not policy.should_retry("tool_mobile_get_autologin_key", 0, None, idempotent=True)
+
+    for attempt in range(5):
+        assert 0 <= policy.delay(attempt) <= 3
+
+    # shared by many threads, no retry is lost
+    threads = [threading.Thread(target=lambda: [policy.record() for _ in range(1000)]) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert policy.retries == 8000
+
+
+def test_retry_closes_response():
+    responses = []
+
+    class FailingPool:
+        session = None
+
+        def post(self, url, **kwargs):
+            response = moodle._make_response(url, b"", 503)
+            response.close = lambda: responses.remove(response)
+            responses.append(response)
+            return response
+
+    pool = FailingPool()
+    pool.session = pool
+    api = moodle.RestApi("https://moodle.example.com", "token", pool=pool, metrics=None,
+                         retry=moodle.RetryPolicy(max_retries=2, backoff=0))
+
+    assert api.core_course_get_contents(courseid=1, _stream=True).status_code == 503
+    # only the response that is returned is still open
+    assert len(responses) == 1
+
+
+def test_cancel_token():
+    token = moodle.CancelToken(timeout=0.05)
+    assert not token.cancelled
+    assert token.timeout(10) <= 0.05
+
+    child = token.child()
+    assert child.deadline == token.deadline
+    time.sleep(0.06)
+    assert token.cancelled and child.cancelled
+    with pytest.raises(moodle.Cancelled):
+        token.check()
+    with pytest.raises(moodle.Cancelled):
+        token.timeout(10)
+
+    # children are cancelled with their parent, not the other way around
+    parent = moodle.CancelToken()
+    child, other = parent.child(), parent.child()
+    child.cancel()
+    assert child.cancelled and not parent.cancelled and not other.cancelled
+    parent.cancel()
+    assert other.cancelled
+    assert parent.child().cancelled
+
+
+def test_cancel_token_wait():
+    token = moodle.CancelToken()
+    start = time.monotonic()
+    token.wait(0.02)
+    assert time.monotonic() - start >= 0.02
+
+    threading.Timer(0.05, token.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(moodle.Cancelled):
+        token.wait(10)
+    assert time.monotonic() - start < 1
+
+
+def test_cancel_token_signal():
+    token = moodle.CancelToken()
+    child = token.child()
+
+    # a signal handler runs in the thread that may hold the lock
+    def handler():
+        with token._lock:
+            token.cancel()
+
+    thread = threading.Thread(target=handler, daemon=True)
+    thread.start()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert child.cancelled
+
+
+def test_cancel_stalled_download(tmp_path):
+    """
+    A download blocked in recv() because the server stopped sending is
+    interrupted by shutting down its socket, the part is kept to resume it
+    """
+    release = threading.Event()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Length", str(1024 * 1024))
+            self.send_header("ETag", '"v1"')
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            # more than a chunk, see moodle.iter_chunks
+            self.wfile.write(b"x" * 200 * 1024)
+            self.wfile.flush()
+            release.wait(10)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/file"
+    helper = moodle.ApiHelper(moodle.RestApi(url, "token", metrics=None))
+
+    cancel = moodle.CancelToken()
+    received = threading.Event()
+    written = []
+    errors = []
+
+    def progress(nbytes):
+        written.append(nbytes)
+        received.set()
+
+    def download():
+        try:
+            helper.get_file(url, tmp_path / "file", cancel, progress=progress)
+        except Exception as e:
+            errors.append((e, time.monotonic()))
+
+    thread = threading.Thread(target=download)
+    thread.start()
+    try:
+        assert received.wait(5)
+        time.sleep(0.1)
+        cancelled = time.monotonic()
+        cancel.cancel()
+        thread.join(5)
+    finally:
+        release.set()
+        server.shutdown()
+
+    (error, failed), = errors
+    assert isinstance(error, moodle.Cancelled)
+    assert failed - cancelled < 0.5
+    assert (tmp_path / "file.part").stat().st_size == sum(written) > 0
+    assert moodle.PartState.load(tmp_path / "file.part", url).etag == '"v1"'
+    assert not (tmp_path / "file").exists()
+
+
+def test_token_bucket():
+    bucket = moodle.TokenBucket(rate=100, burst=2)
+
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() > 0
+    assert bucket.throttled == 1
+
+
+def test_iter_json_array():
+    sections = [
+        {"id": 1, "name": "intro \"[{\\", "modules": [{"id": 2, "name": "}]"}]},
+        {"id": 3, "name": "bräuche", "modules": []},
+    ]
+    body = json.dumps(sections, ensure_ascii=False).encode()
+
+    # tiny chunks split strings, escapes and multibyte characters
+    for chunk_size in (1, 3, 7, len(body)):
+        response = moodle._make_response("url", body)
+        assert list(moodle.iter_json_array(response, chunk_size)) == sections
+
+    exception = moodle._make_response("url", b'{"exception": "x", "message": "no"}')
+    assert list(moodle.iter_json_array(exception)) == []
+    with pytest.raises(moodle.MoodleException, match="no"):
+        list(moodle.iter_json_array(moodle._make_response("url", exception.content), strict=True))
+
+
+def site_info(*functions):
+    info = {"userid": 2, "functions": [{"name": f, "version": ""} for f in functions]}
+    return moodle._make_response("url", json.dumps(info).encode())
+
+
+def test_batch(tmp_path):
+    api = moodle.RestApi("https://moodle.example.com", "token", site_path=tmp_path / "site.json",
+                         metrics=metrics.Metrics())
+    sent = []
+
+    def call(function, **kwargs):
+        sent.append(function)
+        if function == "core_webservice_get_site_info":
+            return site_info(moodle.Batch.FUNCTION)
+        if function == moodle.Batch.FUNCTION:
+            return moodle._make_response("url", json.dumps({"responses": [
+                {"error": False, "data": json.dumps([{"id": 1}])},
+                {"error": True, "exception": json.dumps({"errorcode": "nope", "message": "no"})},
+            ]}).encode())
+
+    api._call = call
+    with api.batch() as batch:
+        a = batch.core_course_get_contents(courseid=1)
+        b = batch.core_course_get_contents(courseid=2)
+
+    assert sent == ["core_webservice_get_site_info", moodle.Batch.FUNCTION]
+    assert a.result().json() == [{"id": 1}]
+    assert b.result().json()["errorcode"] == "nope"
+
+    # every call of the batch is recorded on its own
+    series = api._metrics.snapshot()[("moodle.example.com", "core_course_get_contents")]
+    assert series["count"] == 2
+    assert series["errors"] == {"moodle_exception": 1}
+
+
+def test_batch_fallback(tmp_path):
+    api = moodle.RestApi("https://moodle.example.com", "token", site_path=tmp_path / "site.json")
+    sent = []
+
+    def call(function, **kwargs):
+        sent.append(function)
+        if function == "core_webservice_get_site_info":
+            return site_info(moodle.Batch.FUNCTION)
+        if function == moodle.Batch.FUNCTION:
+            return moodle._make_response("url", b'{"exception": "webservice_access_exception"}')
+        return moodle._make_response("url", json.dumps(kwargs).encode())
+
+    api._call = call
+    with api.batch() as batch:
+        a = batch.core_course_get_contents(courseid=1)
+
+    assert sent == ["core_webservice_get_site_info", moodle.Batch.FUNCTION, "core_course_get_contents"]
+    assert a.result().json() == {"courseid": 1}
+    assert api._batching is False
+
+
+def test_batch_failed(tmp_path):
+    api = moodle.RestApi("https://moodle.example.com", "token", site_path=tmp_path / "site.json")
+    sent = []
+
+    def call(function, **kwargs):
+        sent.append(function)
+        if function == "core_webservice_get_site_info":
+            return site_info(moodle.Batch.FUNCTION)
+        if function == moodle.Batch.FUNCTION:
+            return moodle._make_response("url", b'{"exception": "invalid_parameter_exception"}')
+        return moodle._make_response("url", json.dumps(kwargs).encode())
+
+    api._call = call
+    with api.batch() as batch:
+        a = batch.core_course_get_contents(courseid=1)
+
+    # the calls are sent one by one, but batching is tried again next time
+    assert a.result().json() == {"courseid": 1}
+    assert api._batching is not False
+    with api.batch() as batch:
+        batch.core_course_get_contents(courseid=1)
+    assert sent.count(moodle.Batch.FUNCTION) == 2
+
+
+def test_site_snapshot(tmp_path):
+    api = moodle.RestApi("https://moodle.example.com", "token", site_path=tmp_path / "site.json")
+    sent = []
+
+    def call(function, **kwargs):
+        sent.append(function)
+        return site_info("core_course_get_contents")
+
+    api._call = call
+    assert api.site.userid == 2
+    assert api.supports("core_course_get_contents")
+    assert not api.supports(moodle.Batch.FUNCTION)
+
+    # a new client reads it from disk
+    other = moodle.RestApi("https://moodle.example.com", "token", site_path=tmp_path / "site.json")
+    other._call = call
+    assert other.site.userid == 2
+    assert len(sent) == 1
+
+    # unless it is too old
+    other._site.invalidate()
+    assert other.site.userid == 2
+    assert len(sent) == 2
+
+
+class FakePool:
+    """
+    Serves a single file, honoring range requests like a web server would
+    """
+    def __init__(self, data):
+        self.data = data
+        self.requests = []
+        self.session = self
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        headers = headers or {}
+        self.requests.append(dict(headers))
+
+        if "Range" in headers:
+            start, end = headers["Range"][len("bytes="):].split("-")
+            start, end = int(start), int(end or len(self.data) - 1)
+            if start >= len(self.data):
+                response = moodle._make_response(url, b"", 416)
+                response.headers["Content-Range"] = f"bytes */{len(self.data)}"
+                return response
+
+            response = moodle._make_response(url, self.data[start:end + 1], 206)
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{len(self.data)}"
+        else:
+            response = moodle._make_response(url, self.data)
+
+        response.headers["ETag"] = '"v1"'
+        response.headers["Accept-Ranges"] = "bytes"
+        response.headers["Content-Length"] = str(len(response.content))
+        return response
+
+
+def test_get_file_resume(tmp_path):
+    pool = FakePool(b"0123456789")
+    helper = moodle.ApiHelper(moodle.RestApi("https://moodle.example.com", "token", pool=pool, metrics=None))
+    target = tmp_path / "file.pdf"
+
+    # left behind by a download that was interrupted
+    (tmp_path / "file.pdf.part").write_bytes(b"0123")
+    moodle.PartState(tmp_path / "file.pdf.part", "url", etag='"v1"', size=10).save()
+
+    helper.get_file("url", target)
+    assert pool.requests[-1] == {"Range": "bytes=4-", "If-Range": '"v1"'}
+    assert target.read_bytes() == b"0123456789"
+    assert list(tmp_path.iterdir()) == [target]
+
+    # a part of another url is not resumed
+    (tmp_path / "file.pdf.part").write_bytes(b"xx")
+    moodle.PartState(tmp_path / "file.pdf.part", "other").save()
+    helper.get_file("url", target)
+    assert pool.requests[-1] == {}
+    assert target.read_bytes() == b"0123456789"
+
+
+def test_get_file_resume_complete(tmp_path):
+    pool = FakePool(b"0123456789")
+    helper = moodle.ApiHelper(moodle.RestApi("https://moodle.example.com", "token", pool=pool, metrics=None))
+    target = tmp_path / "file.pdf"
+
+    # interrupted after the last byte but before the rename, the server
+    # answers 416 to the range
+    (tmp_path / "file.pdf.part").write_bytes(b"0123456789")
+    moodle.PartState(tmp_path / "file.pdf.part", "url", etag='"v1"', size=10).save()
+
+    progress = []
+    digest = hashlib.sha256()
+    helper.get_file("url", target, progress=progress.append, digest=digest)
+    assert pool.requests[-1] == {"Range": "bytes=10-", "If-Range": '"v1"'}
+    assert target.read_bytes() == b"0123456789"
+    assert list(tmp_path.iterdir()) == [target]
+    assert sum(progress) == 10
+    assert digest.hexdigest() == hashlib.sha256(b"0123456789").hexdigest()
+
+
+def test_get_file_segments(tmp_path):
+    pool = FakePool(bytes(range(256)) * 40)
+    api = moodle.RestApi("https://moodle.example.com", "token", pool=pool, metrics=None)
+    helper = moodle.ApiHelper(api, segments=4, segment_threshold=1024)
+
+    helper.get_file("url", tmp_path / "file")
+    assert (tmp_path / "file").read_bytes() == pool.data
+    assert sorted(r.get("Range", "") for r in pool.requests) == [
+        "", "bytes=2560-5119", "bytes=5120-7679", "bytes=7680-10239"]
+
+
+def test_get_file_segments_saves(tmp_path, monkeypatch):
+    pool = FakePool(bytes(range(256)) * 16 * 1024)
+    helper = moodle.ApiHelper(moodle.RestApi("https://moodle.example.com", "token", pool=pool, metrics=None),
+                              segments=4, segment_threshold=1024)
+    saves = []
+    save = moodle.PartState.save
+    monkeypatch.setattr(moodle.PartState, "save", lambda state: saves.append(list(state.segments)) or save(state))
+    monkeypatch.setattr(moodle, "SEGMENTS_SAVE_BYTES", 1024 * 1024)
+
+    helper.get_file("url", tmp_path / "file")
+    assert (tmp_path / "file").read_bytes() == pool.data
+    # not at every chunk, but every MiB and once at the end
+    assert 2 <= len(saves) <= 6
+    assert sum(s[2] for s in saves[-1]) == len(pool.data)
+
+
+
+class FakeSite:
+    """
+    Hands out autologin keys and serves a folder archive behind a login,
+    only to the mobile app like Moodle does
+    """
+    URL = "https://moodle.example.com"
+
+    def __init__(self, archive=b"PK", autologin=True):
+        self.archive = archive
+        self.autologin = autologin
+        self.session = self
+        self.keys = 0
+        self.current = None
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        function = data.get("wsfunction")
+        if function == "core_webservice_get_site_info":
+            return site_info(*([moodle.WebSession.FUNCTION] if self.autologin else []))
+        if function == moodle.WebSession.FUNCTION:
+            if not self.autologin:
+                body = {"exception": "webservice_access_exception", "message": "access denied"}
+            elif "MoodleMobile" not in (headers or {}).get("User-Agent", ""):
+                body = {"exception": "moodle_exception", "errorcode": "apprequired", "message": "app required"}
+            else:
+                self.keys += 1
+                body = {"key": f"key{self.keys}", "autologinurl": f"{self.URL}/admin/tool/mobile/autologin.php"}
+            return moodle._make_response(url, json.dumps(body).encode())
+
+        # a file of the folder
+        return moodle._make_response(url, url.encode())
+
+    def get(self, url, params=None, headers=None, cookies=None, **kwargs):
+        if url.endswith("/autologin.php"):
+            response = moodle._make_response(url, b"")
+            if "MoodleMobile" in (headers or {}).get("User-Agent", "") and params["key"] == f"key{self.keys}":
+                self.current = f"session{self.keys}"
+                response.cookies.set("MoodleSession", self.current)
+            return response
+
+        if not cookies or cookies.get("MoodleSession") != self.current:
+            return moodle._make_response(f"{self.URL}/login/index.php", b"<html>")
+
+        response = moodle._make_response(url, self.archive)
+        response.headers["Content-Type"] = "application/zip"
+        return response
+
+    def expire(self):
+        self.current = None
+
+
+def web_helper(tmp_path, site):
+    api = moodle.RestApi(FakeSite.URL, "token", pool=site, metrics=None, site_path=tmp_path / "site.json")
+    return moodle.ApiHelper(api, web=moodle.WebSession(api, "private"))
+
+
+def test_web_session(tmp_path):
+    site = FakeSite()
+    helper = web_helper(tmp_path, site)
+    url = helper.folder_archive_url(3)
+    assert helper.web.supported
+
+    assert helper.get_archive(url, b"".join) == b"PK"
+    assert helper.get_archive(url, b"".join) == b"PK"
+    # the key is asked only once
+    assert site.keys == 1
+
+    # an expired session logs in again
+    site.expire()
+    assert helper.get_archive(url, b"".join) == b"PK"
+    assert site.keys == 2
+
+
+def test_web_session_fallback(tmp_path):
+    helper = web_helper(tmp_path, FakeSite(autologin=False))
+    assert not helper.web.supported
+    with pytest.raises(moodle.LoginError):
+        helper.get_archive(helper.folder_archive_url(3), b"".join)
+
+    # the files of the folder are downloaded one by one instead
+    folder = tmp_path / "folder"
+    manager = download.DownloadManager(helper)
+    task = manager.add_archive(helper.folder_archive_url(3), folder, [
+        ("https://moodle.example.com/a.pdf", folder / "a.pdf", 0, 0),
+    ])
+    assert manager.run()
+    assert task.status == download.Status.DONE
+    assert (folder / "a.pdf").read_bytes() == b"https://moodle.example.com/a.pdf"
@@ -0,0 +1,119 @@
+"""
+Startup time of the entry points, measured with python -X importtime as the
+time spent importing the modules that a bare interpreter does not import.
+The tests fail if a budget is exceeded or if a heavy module is imported
+where it is not needed. For a report run it with
+
+    PYTHONPATH=. python test/startup.py
+
+The budgets are about twice the usual times, on a slow machine they can be
+scaled with the environment variable MUDDLE_STARTUP_SCALE, e.g. 3.
+"""
+import pytest
+
+import importlib.util
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# milliseconds
+BUDGET = {
+    "version": 30,
+    "sync": 180,
+    "gui": 260,
+}
+SCALE = float(os.environ.get("MUDDLE_STARTUP_SCALE", 1))
+
+# the window is created, but the event loop returns at once
+GUI = """
+import runpy, sys
+from PyQt6.QtWidgets import QApplication
+QApplication.exec = lambda self: 0
+sys.argv = ["muddle", *sys.argv[1:]]
+runpy.run_module("muddle", run_name="__main__", alter_sys=True)
+"""
+
+# {tmp} is a directory with an empty configuration and log file
+COMMANDS = {
+    "version": ["-m", "muddle", "--version"],
+    # without a server to sync with, it stops once everything is imported
+    "sync": ["-m", "muddle", "-c", "{tmp}/muddle.ini", "-l", "{tmp}/muddle.log", "sync", "{tmp}"],
+    "gui": ["-c", GUI, "-c", "{tmp}/muddle.ini", "-l", "{tmp}/muddle.log", "--gui"],
+}
+
+
+def importtime(args):
+    """
+    Modules imported by python args, mapped to their own import time in
+    microseconds
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        pathlib.Path(tmp, "muddle.ini").write_text("[muddle]\nalways_run_gui = false\n\n[cache]\nenabled = false\n")
+        pathlib.Path(tmp, "muddle.log").touch()
+        env = dict(os.environ, PYTHONPATH=str(ROOT), XDG_CONFIG_HOME=tmp, XDG_CACHE_HOME=tmp,
+                   QT_QPA_PLATFORM="offscreen")
+        p = subprocess.run([sys.executable, "-X", "importtime", *(a.format(tmp=tmp) for a in args)], cwd=ROOT,
+                           env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+    modules = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        self_us, _, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(self_us)
+
+    # sync exits with an error on purpose, but nothing should crash
+    if "Traceback" in p.stderr:
+        raise RuntimeError(f"cannot run {' '.join(args)}:\n{p.stderr}")
+
+    return modules
+
+
+def measure(command):
+    """
+    Modules imported by a command that a bare interpreter does not import
+    and the time it takes to import them in milliseconds
+    """
+    baseline = importtime(["-c", "pass"])
+    modules = {m: t for m, t in importtime(COMMANDS[command]).items() if m not in baseline}
+    return set(modules), sum(modules.values()) / 1000
+
+
+def test_version():
+    modules, ms = measure("version")
+    assert not modules & {"requests", "colorlog", "PyQt6", "muddle.moodle"}
+    assert ms < BUDGET["version"] * SCALE
+
+
+def test_sync():
+    modules, ms = measure("sync")
+    assert "PyQt6" not in modules
+    assert ms < BUDGET["sync"] * SCALE
+
+
+@pytest.mark.skipif(importlib.util.find_spec("PyQt6") is None, reason="PyQt6 is not installed")
+def test_gui():
+    modules, ms = measure("gui")
+    # loaded only for the SWITCH login
+    assert "PyQt6.QtWebEngineWidgets" not in modules
+    assert ms < BUDGET["gui"] * SCALE
+
+
+def main():
+    for command in COMMANDS:
+        try:
+            modules, ms = measure(command)
+        except RuntimeError:
+            print(f"{command:<8} cannot be run")
+            continue
+
+        print(f"{command:<8} {ms:8.1f} ms {len(modules):5} modules, budget {BUDGET[command] * SCALE:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import pytest
+
+import configparser
+import json
+
+from muddle import moodle
+from muddle import sync
+
+
+def test_course_files(tmp_path):
+    course = moodle.Course._fromdict({"id": 2, "shortname": "Math &amp; CS", "fullname": "", "summary": "",
+                                      "startdate": 0, "enddate": 0})
+    section = moodle.Section._fromdict({"id": 1, "course": 2, "section": 0, "name": "Week 1", "summary": "",
+                                        "visible": True, "modules": [
+        {"id": 3, "name": "Slides", "modname": "folder", "contents": [
+            {"type": "file", "filename": "a.pdf", "filepath": "/sub/", "fileurl": "a", "filesize": 4,
+             "timemodified": 1600000000},
+            {"type": "url", "filename": "link", "fileurl": "https://example.com"},
+        ]},
+        {"id": 4, "name": "Forum", "modname": "forum"},
+    ]})
+
+    files = list(sync.course_files(course, [section], tmp_path))
+    assert files == [("a", tmp_path / "Math & CS" / "Week 1" / "Slides" / "sub" / "a.pdf", 4, 1600000000)]
+
+
+def fake_sync(tmp_path, answers):
+    """
+    A Sync whose webservice calls are answered by answers[function], a
+    JSON-able body or None for a server that cannot be reached
+    """
+    config = configparser.ConfigParser()
+    config.read_dict({"server": {"url": "https://moodle.example.com", "token": "token",
+                                 "site_info_file": str(tmp_path / "site.json")},
+                      "cache": {"enabled": "false"}})
+    syncer = sync.Sync(config, tmp_path)
+
+    def call(function, **kwargs):
+        body = answers.get(function, {"userid": 2, "functions": []})
+        return None if body is None else moodle._make_response("url", json.dumps(body).encode())
+
+    syncer.instance.api._call = call
+    return syncer
+
+
+def test_sync_unreachable(tmp_path):
+    with fake_sync(tmp_path, {"core_enrol_get_users_courses": None}) as syncer:
+        with pytest.raises(moodle.MoodleException):
+            syncer.run()
+
+
+def test_sync_skips_failed_course(tmp_path):
+    courses = [{"id": id, "shortname": name, "fullname": "", "summary": "", "startdate": 0, "enddate": 0}
+               for id, name in [(1, "locked"), (2, "open")]]
+    contents = {1: {"exception": "require_login_exception", "message": "Course or activity not accessible."},
+                2: []}
+
+    with fake_sync(tmp_path, {"core_enrol_get_users_courses": courses}) as syncer:
+        def call(function, courseid=None, **kwargs):
+            if function == "core_course_get_contents":
+                listed.append(courseid)
+                return moodle._make_response("url", json.dumps(contents[courseid]).encode())
+            return other(function, **kwargs)
+
+        listed = []
+        other = syncer.instance.api._call
+        syncer.instance.api._call = call
+        syncer.run()
+
+    # the other courses are still synced
+    assert listed == [1, 2]
+    assert syncer.failed_courses == ["locked"]